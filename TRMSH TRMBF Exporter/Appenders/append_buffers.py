@@ -1,6 +1,10 @@
 if __name__ == "__main__":
     import os, sys, json, argparse
 
+    ## trinity_io.py lives one folder up, next to the exporter
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import trinity_io
+
     parser = argparse.ArgumentParser(description="TRMBF Appender")
 
     append_file_action = parser.add_argument(
@@ -21,19 +25,18 @@ if __name__ == "__main__":
 
     files = os.listdir(args.folder)
 
+    ## The byte arrays are copied straight from each file into the output
+    ## while it is written, they are never loaded as python lists
     for filename in files:
         if ".trmbf.json" in filename:
-            infile = open(os.path.join(args.folder, filename), "rb")
-            new_data = json.loads(infile.read())
-            infile.close()
-
-            new_buffer = {"index_buffer": [{"buffer": []}], "vertex_buffer": [{"buffer": []}]}
+            arrays = trinity_io.find_json_arrays(os.path.join(args.folder, filename))
 
-            new_buffer["index_buffer"][0]["buffer"].extend(new_data["index_buffer"])
-            new_buffer["vertex_buffer"][0]["buffer"].extend(new_data["vertex_buffer"])
+            new_buffer = {
+                "index_buffer": [{"buffer": arrays["index_buffer"]}],
+                "vertex_buffer": [{"buffer": arrays["vertex_buffer"]}],
+            }
 
             buf["buffers"].append(new_buffer)
 
-    outfile = open(args.outfile, "w")
-    outfile.write(json.dumps(buf, indent=4))
-    outfile.close()
+    with open(args.outfile, "w", buffering=1 << 20) as outfile:
+        trinity_io.write_json_indented(outfile, buf)
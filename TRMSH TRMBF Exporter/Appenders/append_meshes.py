@@ -1,6 +1,10 @@
 if __name__ == "__main__":
     import os, sys, json, argparse
 
+    ## trinity_io.py lives one folder up, next to the exporter
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import trinity_io
+
     parser = argparse.ArgumentParser(description="TRMSH Appender")
     append_file_action = parser.add_argument(
         "-a", "--append", help="Append to an existing mesh."
@@ -27,14 +31,10 @@ if __name__ == "__main__":
 
     files = os.listdir(args.folder)
 
+    ## Meshes are only read one at a time while the output is written
     for filename in files:
         if ".trmsh.json" in filename:
-            infile = open(os.path.join(args.folder, filename), "rb")
-            mesh = json.loads(infile.read())
-            infile.close()
-
-            buf["meshes"].append(mesh)
+            buf["meshes"].append(trinity_io.JsonFile(os.path.join(args.folder, filename)))
 
-    outfile = open(args.outfile, "w")
-    outfile.write(json.dumps(buf, indent=4))
-    outfile.close()
\ No newline at end of file
+    with open(args.outfile, "w", buffering=1 << 20) as outfile:
+        trinity_io.write_json_indented(outfile, buf)
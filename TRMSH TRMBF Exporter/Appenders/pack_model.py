@@ -0,0 +1,83 @@
+if __name__ == "__main__":
+    import os, sys, re, json, argparse
+
+    ## trinity_io.py lives one folder up, next to the exporter
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import trinity_io
+
+    parser = argparse.ArgumentParser(description="TRMSH/TRMBF Packer")
+
+    parser.add_argument("folder", help="The folder containing the .trmsh.json/.trmbf.json pairs.")
+    parser.add_argument("model", help="Path of the model without extension, e.g. out/pm0001.")
+    parser.add_argument("--binary", action="store_true", help="Also write the .trmsh/.trmbf files.")
+    parser.add_argument("--no-json", action="store_true", help="Don't write the combined json files.")
+    parser.add_argument("--dedup", action="store_true", help="Store identical buffers once in the .trmbf.")
+
+    args = parser.parse_args()
+
+    ## Every mesh needs its buffer, both lists are built from the same sorted
+    ## names so mesh N always points at buffer N. Numbers in names sort by
+    ## value, so split meshes keep their order (body_2 before body_10).
+    def natural_key(name):
+        return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+    mesh_names = set()
+    buffer_names = set()
+    for filename in os.listdir(args.folder):
+        if filename.endswith(".trmsh.json"):
+            mesh_names.add(filename[:-len(".trmsh.json")])
+        elif filename.endswith(".trmbf.json"):
+            buffer_names.add(filename[:-len(".trmbf.json")])
+
+    ## The combined files of an earlier run into the same folder aren't meshes,
+    ## and they are about to be overwritten while they'd be read
+    model_dir = os.path.dirname(os.path.abspath(args.model))
+    if os.path.realpath(model_dir) == os.path.realpath(args.folder):
+        mesh_names.discard(os.path.basename(args.model))
+        buffer_names.discard(os.path.basename(args.model))
+
+    if mesh_names != buffer_names:
+        unpaired = sorted(mesh_names ^ buffer_names, key=natural_key)
+        raise SystemExit("Meshes and buffers don't pair up: %s" % ", ".join(unpaired))
+
+    names = sorted(mesh_names, key=natural_key)
+    buffer_name = os.path.basename(args.model) + ".trmbf"
+
+    meshes = []
+    buffers = []
+    for name in names:
+        meshes.append(trinity_io.JsonFile(os.path.join(args.folder, name + ".trmsh.json")))
+        arrays = trinity_io.find_json_arrays(os.path.join(args.folder, name + ".trmbf.json"))
+        index_buffer = arrays["index_buffer"]
+        vertex_buffer = arrays["vertex_buffer"]
+
+        ## The binary files need the bytes anyway, the json is then written from them
+        if args.binary:
+            index_buffer = index_buffer.read_bytes()
+            vertex_buffer = vertex_buffer.read_bytes()
+
+        buffers.append({
+            "index_buffer": [{"buffer": index_buffer}],
+            "vertex_buffer": [{"buffer": vertex_buffer}],
+        })
+
+    mesh_data = {"unk0": 0, "meshes": meshes, "buffer_name": buffer_name}
+    buffer_data = {"unused": 0, "buffers": buffers}
+
+    if not args.no_json:
+        with open(args.model + ".trmsh.json", "w", buffering=1 << 20) as outfile:
+            trinity_io.write_json_indented(outfile, mesh_data)
+        with open(args.model + ".trmbf.json", "w", buffering=1 << 20) as outfile:
+            trinity_io.write_json_indented(outfile, buffer_data)
+
+    if args.binary:
+        for index, mesh in enumerate(meshes):
+            with open(mesh.filepath, "rb") as infile:
+                meshes[index] = json.loads(infile.read())
+        trinity_io.write_trmsh(args.model + ".trmsh", mesh_data)
+        saved = trinity_io.write_trmbf(args.model + ".trmbf", buffer_data, args.dedup)
+        if args.dedup:
+            ## Json has no way to share arrays, only the binary file gets smaller
+            print("Identical index/vertex buffers stored once, %d bytes saved" % saved)
+
+    print("Packed %d meshes into %s" % (len(names), buffer_name))
@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+## Headless export of many .blend files.
+## Outside Blender this reads a manifest and runs one background Blender per
+## file, inside Blender (after "--") it exports a single job and writes a result.
+##
+##   python batch_export.py manifest.json --blender <blender> --workers 4 --report report.json
+##
+## Manifest:
+##   {
+##     "settings": {"vcache": 1, ...},
+##     "jobs": [
+##       {"blend": "pm0001.blend", "output": "out/pm0001.trmsh",
+##        "skeleton": "pm0001.trskl", "objects": ["body", "eye"], "settings": {...}}
+##     ]
+##   }
+## Paths are relative to the manifest. "objects" defaults to every mesh in the
+## scene, without "skeleton" the meshes are exported without bone IDs, and the
+## output's name without extension becomes the model name.
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+## Same defaults as the export operators
+DEFAULT_SETTINGS = {
+    "normal": 1,
+    "tangent": 1,
+    "binormal": 0,
+    "uv": 1,
+    "uv_count": 1,
+    "color": 0,
+    "color_count": 1,
+    "skinning": 1,
+    "position_format": "RGB_32_FLOAT",
+    "reference": 0,
+    "weld": 1,
+    "vcache": 0,
+    "split": 0,
+    "binary": 1,
+    "json": 0,
+    "incremental": 0,
+    "parallel": 0,
+    "dedup": 0,
+}
+
+
+def read_manifest(filepath):
+    with open(filepath, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(filepath))
+    jobs = []
+    for job in manifest["jobs"]:
+        settings = dict(DEFAULT_SETTINGS)
+        settings.update(manifest.get("settings", {}))
+        settings.update(job.get("settings", {}))
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError("Unknown export settings: %s" % ", ".join(sorted(unknown)))
+
+        jobs.append({
+            "blend": os.path.join(base_dir, job["blend"]),
+            "output": os.path.join(base_dir, job["output"]),
+            "skeleton": os.path.join(base_dir, job["skeleton"]) if job.get("skeleton") else None,
+            "objects": job.get("objects"),
+            "settings": settings,
+        })
+    return jobs
+
+
+def get_blender_command(blender, job_path, result_path, blend):
+    return [
+        blender, "--background", "--factory-startup", blend,
+        "--python-exit-code", "1",
+        "--python", os.path.abspath(__file__),
+        "--", "--job", job_path, "--result", result_path,
+    ]
+
+
+def run_blender_job(blender, job, work_dir, index, timeout):
+    job_path = os.path.join(work_dir, "job_%d.json" % index)
+    result_path = os.path.join(work_dir, "result_%d.json" % index)
+    with open(job_path, "w", encoding="utf-8") as f:
+        json.dump(job, f)
+
+    report = {"blend": job["blend"], "output": job["output"]}
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(
+            get_blender_command(blender, job_path, result_path, job["blend"]),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=timeout,
+        )
+        returncode = process.returncode
+        log = process.stdout.decode("utf-8", "replace")
+    except subprocess.TimeoutExpired as e:
+        returncode = None
+        log = (e.stdout or b"").decode("utf-8", "replace") + "\nTimed out after %ss" % timeout
+    report["seconds"] = time.perf_counter() - start
+
+    result = None
+    if returncode == 0 and os.path.exists(result_path):
+        with open(result_path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+
+    if result is None:
+        report["status"] = "failed"
+        report["returncode"] = returncode
+        report["log"] = log[-4000:]
+    else:
+        report["status"] = "ok"
+        report.update(result)
+    return report
+
+
+def run_batch(blender, jobs, workers, timeout=None):
+    ## One background Blender per job, at most workers at a time. The report
+    ## keeps the manifest's order whatever order the exports finish in.
+    with tempfile.TemporaryDirectory() as work_dir:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(run_blender_job, blender, job, work_dir, index, timeout)
+                for index, job in enumerate(jobs)
+            ]
+            return [future.result() for future in futures]
+
+
+def print_report(reports, seconds):
+    for report in reports:
+        if report["status"] == "ok":
+            print("%-8s %8.2fs  %s (%d objects, export %.2fs)" % (
+                report["status"], report["seconds"], report["blend"],
+                len(report["objects"]), report["export_seconds"]))
+        else:
+            print("%-8s %8.2fs  %s" % (report["status"], report["seconds"], report["blend"]))
+            print(report["log"])
+    failed = sum(report["status"] != "ok" for report in reports)
+    print("%d files, %d failed, %.2fs" % (len(reports), failed, seconds))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Export TRMSH/TRMBF from many .blend files.")
+    parser.add_argument("manifest")
+    parser.add_argument("--blender", default="blender")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument("--report", default=None)
+    args = parser.parse_args(argv)
+
+    jobs = read_manifest(args.manifest)
+    start = time.perf_counter()
+    reports = run_batch(args.blender, jobs, max(1, args.workers), args.timeout)
+    print_report(reports, time.perf_counter() - start)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=4)
+    return 1 if any(report["status"] != "ok" for report in reports) else 0
+
+
+def export_job(job):
+    ## Runs inside Blender with the job's .blend already open
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import operator_buffer_export as exporter
+
+    if job["objects"] is None:
+        objects = [obj for obj in bpy.context.scene.objects if obj.type == "MESH"]
+    else:
+        missing = [name for name in job["objects"] if name not in bpy.data.objects]
+        if missing:
+            raise KeyError("Objects not in %s: %s" % (job["blend"], ", ".join(missing)))
+        objects = [bpy.data.objects[name] for name in job["objects"]]
+
+    bone_dict = exporter.readtrskl(job["skeleton"]) if job["skeleton"] else {}
+
+    dest_dir = os.path.dirname(job["output"])
+    model_name = os.path.splitext(os.path.basename(job["output"]))[0]
+    os.makedirs(dest_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    exporter.export_objects(bpy.context, dest_dir, model_name, objects, job["settings"], bone_dict)
+    return {
+        "objects": [obj.name for obj in objects],
+        "export_seconds": time.perf_counter() - start,
+    }
+
+
+def main_blender(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--job", required=True)
+    parser.add_argument("--result", required=True)
+    args = parser.parse_args(argv)
+
+    with open(args.job, "r", encoding="utf-8") as f:
+        job = json.load(f)
+    result = export_job(job)
+    with open(args.result, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+if __name__ == "__main__":
+    if bpy is None:
+        sys.exit(main(sys.argv[1:]))
+    else:
+        main_blender(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
@@ -1,161 +1,117 @@
 import bpy
-from mathutils import Vector
-import os, json, struct
+import os, sys, struct, json
+import numpy as np
 
 # import fake_bpy as bpy
 
+def get_script_dir():
+    ## Run from the Text Editor, __file__ is "<blend path>/<text name>" even for a
+    ## text opened from disk, the text's own filepath says where the script is.
+    ## Imported as a module (batch_export.py), __file__ is the real path.
+    text = bpy.data.texts.get(os.path.basename(__file__))
+    if text is not None and text.filepath:
+        return os.path.dirname(bpy.path.abspath(text.filepath))
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+## The array helpers live next to this script
+sys.path.append(get_script_dir())
+import trinity_bounds
+import trinity_buffers
+import trinity_io
+
 TRMBF = ".trmbf"
 TRMSH = ".trmsh"
+JSON = ".json"
+PALETTE = ".palette"
+MANIFEST = ".manifest"
+CACHE = ".cache"
+CACHE_DIR = "_cache"
+
+## Bump when the exporter's output changes, so old manifests aren't reused
+MANIFEST_VERSION = 3
 
-vertFormat = struct.Struct("<fff")
-normFormat = struct.Struct("<eeee")
-uvFormat = struct.Struct("<ff")
-colorFormat = struct.Struct("bbbb")
-mtFormat = struct.Struct("<BBBB")
-wtFormat = struct.Struct("<HHHH")
 polyFormat = struct.Struct("<HHH")
+poly32Format = struct.Struct("<III")
+
+def get_part_suffix(index, parts):
+    if len(parts) == 1:
+        return ""
+    return "_%d" % index
 
-def get_poly_count_for_mat(obj, material_name):
-    polyCount = 0
-    for poly in obj.data.polygons:
-        if obj.data.materials[poly.material_index].name == material_name:
-                polyCount += 1
-    return polyCount
 
-def write_mesh_data(context, filepath, obj, settings):
+def write_mesh_data(context, dest_dir, obj, settings, parts):
     if obj.type != "MESH":
         return -1
 
-    bboxco = [Vector(co) for co in obj.bound_box]
+    meshes = []
+    for index, part in enumerate(parts):
+        meshes.append(write_mesh_part(context, dest_dir, obj, settings, parts, index))
+    return meshes
+
 
-    minbbox = min(bboxco)
-    maxbbox = max(bboxco)
+def write_mesh_part(context, dest_dir, obj, settings, parts, part_index):
+    part = parts[part_index]
+    suffix = get_part_suffix(part_index, parts)
+
+    layout = trinity_buffers.compile_vertex_layout(settings)
+
+    ## Bounds of the positions as they are stored in this part's vertex buffer
+    verts = np.frombuffer(part["vertex_buffer"], dtype=layout["dtype"])
+    positions = verts["POSITION_0"][:, :3].astype(np.float64)
+    minbbox, maxbbox = trinity_bounds.get_aabb(positions)
+    clip_sphere_pos, clip_sphere_radius = trinity_bounds.get_bounding_sphere(positions)
 
     bbox = {
         "min": {
-            "x": round(minbbox.x, 6),
-            "y": round(minbbox.y, 6),
-            "z": round(minbbox.z, 6),
+            "x": round(float(minbbox[0]), 6),
+            "y": round(float(minbbox[1]), 6),
+            "z": round(float(minbbox[2]), 6),
         },
         "max": {
-            "x": round(maxbbox.x, 6),
-            "y": round(maxbbox.y, 6),
-            "z": round(maxbbox.z, 6),
+            "x": round(float(maxbbox[0]), 6),
+            "y": round(float(maxbbox[1]), 6),
+            "z": round(float(maxbbox[2]), 6),
         },
     }
 
-    clip_sphere_pos = (minbbox + maxbbox) / 2
-    clip_sphere_radius = (maxbbox - minbbox).length / 2
-
     clip_sphere = {
-        "x": round(clip_sphere_pos.x, 6),
-        "y": round(clip_sphere_pos.y, 6),
-        "z": round(clip_sphere_pos.z, 6),
-        "radius": round(clip_sphere_radius, 6),
+        "x": round(float(clip_sphere_pos[0]), 6),
+        "y": round(float(clip_sphere_pos[1]), 6),
+        "z": round(float(clip_sphere_pos[2]), 6),
+        "radius": clip_sphere_radius,
     }
-
-    vtx_size = vertFormat.size
-    vtx_attrs = [
-        {
-            "attr_0" : 0,
-            "attribute": "POSITION",
-            "attribute_layer": 0,
-            "type": "RGB_32_FLOAT",
-            "position": 0,
-        }
-    ]
-
-    if settings["normal"] == 1:
-        vtx_attrs.append(
-            {
-                "attr_0" : 0,
-                "attribute": "NORMAL",
-                "attribute_layer": 0,
-                "type": "RGBA_16_FLOAT",
-                "position": vtx_size,
-            }
-        )
-        vtx_size += normFormat.size
-
-    if settings["tangent"] == 1:
-        vtx_attrs.append(
-            {
-                "attr_0" : 0,
-                "attribute": "TANGENT",
-                "attribute_layer": 0,
-                "type": "RGBA_16_FLOAT",
-                "position": vtx_size,
-            }
-        )
-        vtx_size += normFormat.size
-
-    if settings["uv"] == 1:
-        for i in range(settings["uv_count"]):
-            vtx_attrs.append(
-                {
-                    "attr_0" : 0,
-                    "attribute": "TEXCOORD",
-                    "attribute_layer": i,
-                    "type": "RG_32_FLOAT",
-                    "position": vtx_size,
-                },
-            )
-            vtx_size += uvFormat.size
-
-    if settings["color"] == 1:
-        for i in range(settings["color_count"]):
-            vtx_attrs.append(
-                {
-                    "attr_0" : 0,
-                    "attribute": "COLOR",
-                    "attribute_layer": i,
-                    "type": "RGBA_8_UNORM",
-                    "position": vtx_size,
-                },
-            )
-            vtx_size += uvFormat.size
-
-    if settings["skinning"] == 1:
-        vtx_attrs.append(
-            {
-                "attr_0" : 0,
-                "attribute": "BLEND_INDICES",
-                "attribute_layer": 0,
-                "type": "RGBA_8_UNSIGNED",
-                "position": vtx_size,
-            }
-        )
-        vtx_size += mtFormat.size
-        vtx_attrs.append(
-            {
-                "attr_0" : 0,
-                "attribute": "BLEND_WEIGHTS",
-                "attribute_layer": 0,
-                "type": "RGBA_16_UNORM",
-                "position": vtx_size,
-            }
-        )
-        vtx_size += wtFormat.size
+    print("%s: clip sphere radius %.6g (box corners %.6g)" % (
+        obj.name + suffix, clip_sphere_radius, np.linalg.norm(maxbbox - minbbox) / 2))
+
+    ## The trmsh has nowhere to store them, so the per material bounds are only reported
+    tris = np.frombuffer(part["index_buffer"], dtype="<u2" if part["polygon_type"] == "UINT16" else "<u4")
+    material_bounds = trinity_bounds.get_material_bounds(positions, tris, part["material_ranges"])
+    for material, bounds in zip(obj.material_slots, material_bounds):
+        if bounds is not None:
+            (material_min, material_max), (material_center, material_radius) = bounds
+            print("    %s: min (%.6g, %.6g, %.6g) max (%.6g, %.6g, %.6g) sphere (%.6g, %.6g, %.6g) radius %.6g" % (
+                (material.name,) + tuple(material_min) + tuple(material_max) + tuple(material_center) + (material_radius,)))
 
     attributes = [{
-        "attrs": vtx_attrs,
-        "size": [{"size": vtx_size}],
+        "attrs": layout["attrs"],
+        "size": [{"size": layout["size"]}],
     }]
     materials = []
+    ## The index buffer is grouped by material slot, so every slot is one contiguous range
+    material_ranges = part["material_ranges"]
     for index, material in enumerate(obj.material_slots):
+        ## Submeshes only list the materials they actually use
+        if len(parts) > 1 and material_ranges[index][1] == 0:
+            continue
         if material.name != "":
             new_material = {
                 "material_name": material.name,
-                "poly_offset": 0,
-                #"poly_count": len(obj.data.polygons) * 3,
-                "poly_count": get_poly_count_for_mat(obj, material.name) * 3,
+                "poly_offset": material_ranges[index][0],
+                "poly_count": material_ranges[index][1],
                 "sh_unk3": 0,
                 "sh_unk4": 0,
             }
-            if len(materials) == 1:
-                new_material['poly_offset'] = materials[len(materials) - 1]['poly_count']
-            if len(materials) > 1:
-                new_material['poly_offset'] = materials[len(materials) - 1]['poly_count'] + materials[len(materials) - 1]['poly_offset']
             materials.append(new_material)
         #materials = [
     #    {
@@ -168,9 +124,9 @@ def write_mesh_data(context, filepath, obj, settings):
     #]
 
     mesh = {
-        "mesh_shape_name": obj.data.name,
+        "mesh_shape_name": obj.data.name + suffix,
         "bounds": bbox,
-        "polygon_type": "UINT16",
+        "polygon_type": part["polygon_type"],
         "attributes": attributes,
         "materials": materials,
         "clip_sphere": clip_sphere,
@@ -185,61 +141,227 @@ def write_mesh_data(context, filepath, obj, settings):
                 		}
             ],
         "vis_shapes": [],
-        "mesh_name": obj.name,
+        "mesh_name": obj.name + suffix,
         "unk13": 0
     }
 
-    f = open(filepath, "w", encoding="utf-8")
-    f.write(json.dumps(mesh, indent=4))
-    f.close()
+    if settings["json"] == 1:
+        trinity_io.write_json(os.path.join(dest_dir, obj.name + suffix + TRMSH + JSON), mesh)
 
-    return 0
+    return mesh
 
 
-def write_buffer_data(context, filepath, obj, settings, bone_dict):
-    if obj.type != "MESH":
-        return -1
+def calc_loop_normals(mesh):
+    ## Blender before 4.1 only fills the loop normals on request
+    if hasattr(mesh, "calc_normals_split"):
+        mesh.calc_normals_split()
+
+
+def read_loop_tangents(mesh):
+    ## MikkTSpace is the slow part of an export, only run it when tangents are written
+    mesh.calc_tangents(uvmap=mesh.uv_layers.active.name)
+    tangent = np.empty((len(mesh.loops), 3), dtype=np.float32)
+    mesh.loops.foreach_get("tangent", tangent.ravel())
+    mesh.free_tangents()
+    return tangent
+
+
+def get_uv_layers(mesh, count):
+    ## TEXCOORD_0 is the active layer, the other layers follow in the mesh's order
+    active = mesh.uv_layers.active
+    if active is None:
+        return []
+    layers = [active] + [layer for layer in mesh.uv_layers if layer.name != active.name]
+    return layers[:count]
+
+
+def get_color_layers(mesh, count):
+    ## COLOR_0 is the active color attribute, the others follow in the mesh's order
+    active = mesh.color_attributes.active_color
+    layers = list(mesh.color_attributes)
+    if active is not None:
+        layers.sort(key=lambda layer: layer.name != active.name)
+    return layers[:count]
+
+
+def get_color_key(layer):
+    ## Byte colors are stored as sRGB, color_srgb reads them without the
+    ## linear conversion. Blender versions without it only have color.
+    if len(layer.data) and hasattr(layer.data[0], "color_srgb"):
+        return "color_srgb"
+    return "color"
+
 
+def read_color_layer(layer, loop_vertex):
+    ## Point colors are spread to the loops so every layer is per loop
+    color = np.empty((len(layer.data), 4), dtype=np.float32)
+    layer.data.foreach_get(get_color_key(layer), color.ravel())
+    if layer.domain == "POINT":
+        return color[loop_vertex]
+    return color
+
+
+def report_missing_layers(obj, kind, count, found):
+    if found < count:
+        print("%s: %d %s layers exported but the mesh has %d, the rest are zero" % (obj.name, count, kind, found))
+
+
+def get_group_bone_table(obj, bone_dict):
+    ## Vertex group index -> skeleton bone ID, -1 for groups without a bone
+    group_bones = np.array(
+        [bone_dict.get(group.name, -1) for group in obj.vertex_groups] + [-1],
+        dtype=np.int64,
+    )
+    missing = [group.name for group in obj.vertex_groups if group.name not in bone_dict]
+    if missing:
+        print("%s: %d vertex groups have no bone in the skeleton: %s" % (obj.name, len(missing), ", ".join(missing)))
+    return group_bones
+
+
+def gather_vertex_weights(mesh):
+    ## Vertex groups can't be read with foreach_get, so this is the one
+    ## python loop over the vertices, everything after it works on arrays
+    group_counts = np.zeros(len(mesh.vertices), dtype=np.int64)
+    groups = []
+    weights = []
+    for vert in mesh.vertices:
+        vert_groups = vert.groups
+        group_counts[vert.index] = len(vert_groups)
+        for gp in vert_groups:
+            groups.append(gp.group)
+            weights.append(gp.weight)
+    return group_counts, np.array(groups, dtype=np.int64), np.array(weights, dtype=np.float32)
+
+
+def read_mesh_inputs(obj, settings):
+    ## Everything the array path reads from Blender for this export
+    mesh = obj.data
+    vert_count = len(mesh.vertices)
+    loop_count = len(mesh.loops)
+    poly_count = len(mesh.polygons)
+
+    ## foreach_get only copies in bulk when the buffer matches the property's
+    ## type, int properties are read as int32 and widened afterwards
+    inputs = {
+        "co": np.empty((vert_count, 3), dtype=np.float32),
+        "loop_vertex": np.empty(loop_count, dtype=np.int32),
+        "loop_start": np.empty(poly_count, dtype=np.int32),
+        "loop_total": np.empty(poly_count, dtype=np.int32),
+        "material_index": np.empty(poly_count, dtype=np.int32),
+    }
+    mesh.vertices.foreach_get("co", inputs["co"].ravel())
+    mesh.loops.foreach_get("vertex_index", inputs["loop_vertex"])
+    mesh.polygons.foreach_get("loop_start", inputs["loop_start"])
+    mesh.polygons.foreach_get("loop_total", inputs["loop_total"])
+    mesh.polygons.foreach_get("material_index", inputs["material_index"])
+    for key in ("loop_vertex", "loop_start", "loop_total", "material_index"):
+        inputs[key] = inputs[key].astype(np.int64)
+
+    ## Tangents depend on the normals and the active UVs, so those are read
+    ## whenever tangents are exported even if they aren't written themselves
+    if settings["normal"] == 1 or settings["tangent"] == 1:
+        calc_loop_normals(mesh)
+        inputs["normal"] = np.empty((loop_count, 3), dtype=np.float32)
+        mesh.loops.foreach_get("normal", inputs["normal"].ravel())
+    ## One (layers, loops, n) array per kind, each layer is read straight into its slice
+    if settings["uv"] == 1 or settings["tangent"] == 1:
+        uv_layers = get_uv_layers(mesh, settings["uv_count"] if settings["uv"] == 1 else 1)
+        if settings["uv"] == 1:
+            report_missing_layers(obj, "UV", settings["uv_count"], len(uv_layers))
+        inputs["uv"] = np.empty((len(uv_layers), loop_count, 2), dtype=np.float32)
+        for layer, uv in zip(uv_layers, inputs["uv"]):
+            layer.data.foreach_get("uv", uv.ravel())
+    if settings["color"] == 1:
+        color_layers = get_color_layers(mesh, settings["color_count"])
+        report_missing_layers(obj, "color", settings["color_count"], len(color_layers))
+        inputs["color"] = np.empty((len(color_layers), loop_count, 4), dtype=np.float32)
+        for layer, color in zip(color_layers, inputs["color"]):
+            color[...] = read_color_layer(layer, inputs["loop_vertex"])
+
+    if settings["skinning"] == 1:
+        inputs["group_counts"], inputs["groups"], inputs["weights"] = gather_vertex_weights(mesh)
+
+    return inputs
+
+
+def gather_mesh_arrays(obj, settings, bone_dict, inputs=None):
+    mesh = obj.data
+    if inputs is None:
+        inputs = read_mesh_inputs(obj, settings)
+
+    arrays = {
+        "co": inputs["co"],
+        "loop_vertex": inputs["loop_vertex"],
+        "loop_start": inputs["loop_start"],
+        "loop_total": inputs["loop_total"],
+        "material_index": inputs["material_index"],
+        "material_count": len(obj.material_slots),
+    }
+
+    if settings["normal"] == 1:
+        arrays["normal"] = inputs["normal"]
+    if settings["uv"] == 1:
+        arrays["uv"] = inputs["uv"]
+    if settings["color"] == 1:
+        arrays["color"] = inputs["color"]
+    if settings["tangent"] == 1:
+        content_hash = trinity_buffers.get_content_hash([
+            inputs["co"], inputs["loop_vertex"], inputs["loop_start"], inputs["loop_total"],
+            inputs["normal"], inputs["uv"][:1],
+        ])
+        arrays["tangent"] = trinity_buffers.derived_cache.get(
+            mesh.name_full, content_hash, "tangent", lambda: read_loop_tangents(mesh)
+        )
+
+    if settings["skinning"] == 1:
+        group_bones = get_group_bone_table(obj, bone_dict)
+        arrays["blend_indices"], arrays["blend_weights"] = trinity_buffers.get_blend_arrays(
+            inputs["group_counts"], group_bones[inputs["groups"]], inputs["weights"]
+        )
+
+    return arrays
+
+
+def build_buffer_bytes_reference(obj, settings, layout, bone_dict):
+    ## Original per-loop exporter, kept as the reference for the array path
     mesh = obj.data
-    mesh.calc_tangents()
 
     vert_data = [None] * len(mesh.vertices)
     poly_data = []
 
-    material_data = []
+    material_data = [[] for i in range(len(obj.material_slots))]
+    missing = set()
 
     ## Accumulate all the relevant data
     ## TODO: make it possible later for different presets
     ## for trainers, pokemon, buildings
 
-    # uvs = []
-    uv = mesh.uv_layers.active.data
-
-    # if settings["uv"] == 1:
-    # uv = mesh.uv_layers.active.data
+    uv_layers = get_uv_layers(mesh, settings["uv_count"]) if settings["uv"] == 1 else []
+    color_layers = get_color_layers(mesh, settings["color_count"]) if settings["color"] == 1 else []
+    color_keys = [get_color_key(layer) for layer in color_layers]
 
     for poly in mesh.polygons:
         pol = []
         for loop_index in poly.loop_indices:
-            vert_d = []
+            vert_d = {}
 
             loop = mesh.loops[loop_index]
             vidx = loop.vertex_index
             pol.append(loop.vertex_index)
 
             vert = mesh.vertices[vidx]
-            pos = (vert.co[0], vert.co[1], vert.co[2])
-            vert_d.append(pos)
+            vert_d["POSITION_0"] = (vert.co[0], vert.co[1], vert.co[2])
 
             if settings["normal"] == 1:
-                nor = (loop.normal[0], loop.normal[1], loop.normal[2])
-                vert_d.append(nor)
+                vert_d["NORMAL_0"] = (loop.normal[0], loop.normal[1], loop.normal[2], 0.0)
             if settings["tangent"] == 1:
-                tan = (loop.tangent[0], loop.tangent[1], loop.tangent[2])
-                vert_d.append(tan)
-            if settings["uv"] == 1:
-                tex = (uv[loop_index].uv[0], uv[loop_index].uv[1])
-                vert_d.append(tex)
+                vert_d["TANGENT_0"] = (loop.tangent[0], loop.tangent[1], loop.tangent[2], 0.0)
+            for i, layer in enumerate(uv_layers):
+                uv = layer.data[loop_index].uv
+                vert_d["TEXCOORD_%d" % i] = (uv[0], uv[1])
+            for i, layer in enumerate(color_layers):
+                color = getattr(layer.data[vidx if layer.domain == "POINT" else loop_index], color_keys[i])
+                vert_d["COLOR_%d" % i] = [min(max(round(c * 0xFF), 0), 0xFF) for c in color]
 
             if settings["skinning"] == 1:
                 grp = []
@@ -248,68 +370,280 @@ def write_buffer_data(context, filepath, obj, settings, bone_dict):
                     group_name = obj.vertex_groups[gp.group].name
                     if group_name in bone_dict:
                         bone_id = bone_dict[group_name]
-                        print("Bone ID:", bone_id)
                         grp.append((bone_id, gp.weight))
                     else:
-                        print("Bone not found.")
+                        missing.add(group_name)
 
                 while len(grp) < 4:
                     grp.append((0, 0.0))
 
                 grp = grp[0:4]
-                vert_d.append(grp)
+                vert_d["BLEND_INDICES_0"] = [x[0] for x in grp]
+                vert_d["BLEND_WEIGHTS_0"] = [int(x[1] * 0xFFFF) for x in grp]
 
             vert_data[vidx] = vert_d
-        poly_data.append(pol)
+
+        while len(material_data) <= poly.material_index:
+            material_data.append([])
+        material_data[poly.material_index].append(pol)
+
+    if missing:
+        print("%s: %d vertex groups have no bone in the skeleton: %s" % (obj.name, len(missing), ", ".join(sorted(missing))))
+
+    material_ranges = []
+    for polys in material_data:
+        material_ranges.append((len(poly_data) * 3, len(polys) * 3))
+        poly_data.extend(polys)
 
     ## Write poly bytes
-    ## TODO: make it possible later for different polytypes
-    poly_bytes = b""
+    if len(vert_data) > 0x10000:
+        polygon_type = "UINT32"
+        index_format = poly32Format
+    else:
+        polygon_type = "UINT16"
+        index_format = polyFormat
+    poly_bytes = bytearray(len(poly_data) * index_format.size)
 
-    for poly in poly_data:
-        poly_bytes += polyFormat.pack(poly[0], poly[1], poly[2])
+    for i, poly in enumerate(poly_data):
+        index_format.pack_into(poly_bytes, i * index_format.size, poly[0], poly[1], poly[2])
 
     ## Write vert bytes
     ## TODO: make it possible later for using different presets
     ## Such as extra UVs for Buildings, extra vertex colors, etc.
-    vert_bytes = b""
+    vert_bytes = bytearray(len(vert_data) * layout["size"])
+
+    for i, vert in enumerate(vert_data):
+        for attr in layout["attrs"]:
+            name = trinity_buffers.get_field_name(attr)
+            if name in vert:
+                offset = i * layout["size"] + attr["position"]
+                layout["packers"][name].pack_into(vert_bytes, offset, *vert[name])
+
+    return [{
+        "index_buffer": poly_bytes,
+        "vertex_buffer": vert_bytes,
+        "material_ranges": material_ranges,
+        "polygon_type": polygon_type,
+    }]
 
-    for vert in vert_data:
-        cursor = 0
-        co = vert[cursor]
-        vert_bytes += vertFormat.pack(co[0], co[1], co[2])
-        cursor += 1
 
-        if settings["normal"] == 1:
-            norm = vert[cursor]
-            vert_bytes += normFormat.pack(norm[0], norm[1], norm[2], 0.0)
-            cursor += 1
+def write_buffer_data(context, dest_dir, obj, settings, bone_dict, inputs=None):
+    if obj.type != "MESH":
+        return -1
 
+    layout = trinity_buffers.compile_vertex_layout(settings)
+
+    if settings["reference"] == 1:
+        if not trinity_buffers.uses_default_formats(settings):
+            raise ValueError("The reference exporter only writes the default vertex formats.")
         if settings["tangent"] == 1:
-            tan = vert[cursor]
-            vert_bytes += normFormat.pack(tan[0], tan[1], tan[2], 0.0)
-            cursor += 1
+            obj.data.calc_tangents()
+        elif settings["normal"] == 1:
+            calc_loop_normals(obj.data)
+        parts = build_buffer_bytes_reference(obj, settings, layout, bone_dict)
+    else:
+        arrays = gather_mesh_arrays(obj, settings, bone_dict, inputs)
+        parts = trinity_buffers.build_mesh_parts(arrays, layout, settings)
 
-        if settings["uv"] == 1:
-            tex = vert[cursor]
-            vert_bytes += uvFormat.pack(tex[0], tex[1])
-            cursor += 1
+    write_buffer_json(dest_dir, obj, settings, parts)
+    return parts
 
-        if settings["skinning"] == 1:
-            grps = list([x[0] for x in vert[cursor]])
-            vert_bytes += mtFormat.pack(grps[0], grps[1], grps[2], grps[3])
 
-            wgts = list([int(x[1] * 0xFFFF) for x in vert[cursor]])
-            vert_bytes += wtFormat.pack(wgts[0], wgts[1], wgts[2], wgts[3])
+def write_buffer_json(dest_dir, obj, settings, parts):
+    if settings["json"] == 1:
+        for index, part in enumerate(parts):
+            data = {
+                "index_buffer": part["index_buffer"],
+                "vertex_buffer": part["vertex_buffer"],
+            }
 
-    data = {
-        "index_buffer": list(poly_bytes),
-        "vertex_buffer": list(vert_bytes),
-    }
+            trinity_io.write_json(
+                os.path.join(dest_dir, obj.name + get_part_suffix(index, parts) + TRMBF + JSON),
+                data,
+            )
 
-    f = open(filepath, "w", encoding="utf-8")
-    f.write(json.dumps(data, indent=4))
-    f.close()
+
+def build_objects_in_pool(context, dest_dir, objects, settings, bone_dict, inputs):
+    ## Blender's data is only read here on the main thread, the arrays are then
+    ## welded, optimized and packed by worker processes, one object per task
+    extracted = [
+        gather_mesh_arrays(obj, settings, bone_dict, obj_inputs)
+        for obj, obj_inputs in zip(objects, inputs)
+    ]
+    workers = min(len(objects), os.cpu_count() or 1)
+    all_parts = trinity_buffers.build_mesh_parts_in_pool(extracted, settings, workers)
+    for obj, parts in zip(objects, all_parts):
+        write_buffer_json(dest_dir, obj, settings, parts)
+    return all_parts
+
+
+def get_export_hash(obj, inputs, settings, bone_dict):
+    ## Hash of everything an object's export depends on: the mesh arrays, vertex
+    ## group and material names, the export settings and the skeleton's bone IDs
+    names = {
+        "version": MANIFEST_VERSION,
+        "object": obj.name,
+        "mesh": obj.data.name,
+        "groups": [group.name for group in obj.vertex_groups],
+        "materials": [slot.name for slot in obj.material_slots],
+        "settings": sorted((key, value) for key, value in settings.items() if key not in ("incremental", "parallel", "dedup")),
+        "bones": sorted(bone_dict.items()) if settings["skinning"] == 1 else [],
+    }
+    arrays = [inputs[key] for key in sorted(inputs)]
+    arrays.append(np.frombuffer(json.dumps(names).encode("utf-8"), dtype=np.uint8))
+    return trinity_buffers.get_content_hash(arrays)
+
+
+def read_manifest(dest_dir, model_name):
+    try:
+        with open(os.path.join(dest_dir, model_name + MANIFEST + JSON), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["objects"]
+
+
+def read_cached_object(cache_dir, entry):
+    ## Buffers of an unchanged object from its cache file, None if it's gone
+    try:
+        with open(os.path.join(cache_dir, entry["hash"] + CACHE), "rb") as f:
+            data = memoryview(f.read())
+    except OSError:
+        return None
+
+    parts = []
+    offset = 0
+    for index_size, vertex_size in entry["buffers"]:
+        parts.append({
+            "index_buffer": data[offset:offset + index_size],
+            "vertex_buffer": data[offset + index_size:offset + index_size + vertex_size],
+        })
+        offset += index_size + vertex_size
+    if offset != len(data):
+        return None
+    return parts
+
+
+def write_cached_object(cache_dir, object_hash, parts):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, object_hash + CACHE), "wb") as f:
+        for part in parts:
+            f.write(part["index_buffer"])
+            f.write(part["vertex_buffer"])
+
+
+def export_objects(context, dest_dir, model_name, objects, settings, bone_dict):
+    meshes = []
+    buffers = []
+    palettes = {}
+
+    ## Incremental exports keep every object's meshes and buffers next to the
+    ## output and only rebuild the objects whose inputs changed since the last run
+    incremental = settings["incremental"] == 1
+    cache_dir = os.path.join(dest_dir, model_name + CACHE_DIR)
+    previous = read_manifest(dest_dir, model_name) if incremental else {}
+    manifest = {}
+    reused = 0
+
+    ## Objects whose buffers are rebuilt, the rest come from the cache
+    exported = []
+    rebuilt = []
+
+    for obj in objects:
+        if obj.type != "MESH":
+            continue
+
+        inputs = None
+        object_hash = None
+        if incremental:
+            inputs = read_mesh_inputs(obj, settings)
+            object_hash = get_export_hash(obj, inputs, settings, bone_dict)
+            entry = previous.get(obj.name)
+            if entry is not None and entry["hash"] == object_hash:
+                parts = read_cached_object(cache_dir, entry)
+                if parts is not None:
+                    exported.append((obj, parts, entry))
+                    manifest[obj.name] = entry
+                    reused += 1
+                    continue
+
+        exported.append((obj, None, None))
+        rebuilt.append((obj, inputs, object_hash))
+
+    if settings["parallel"] == 1 and settings["reference"] != 1 and len(rebuilt) > 1:
+        rebuilt_parts = build_objects_in_pool(
+            context, dest_dir,
+            [obj for obj, inputs, object_hash in rebuilt], settings, bone_dict,
+            [inputs for obj, inputs, object_hash in rebuilt],
+        )
+    else:
+        rebuilt_parts = [
+            write_buffer_data(context, dest_dir, obj, settings, bone_dict, inputs)
+            for obj, inputs, object_hash in rebuilt
+        ]
+
+    ## Meshes and buffers go out in selection order however they were built
+    rebuilt = iter(zip(rebuilt, rebuilt_parts))
+    for obj, parts, entry in exported:
+        if entry is not None:
+            obj_meshes = entry["meshes"]
+            obj_palettes = entry["palettes"]
+        else:
+            (obj, inputs, object_hash), parts = next(rebuilt)
+            obj_meshes = write_mesh_data(context, dest_dir, obj, settings, parts)
+            obj_palettes = {}
+            for mesh, part in zip(obj_meshes, parts):
+                if "bone_palette" in part:
+                    obj_palettes[mesh["mesh_name"]] = part["bone_palette"]
+            if incremental:
+                write_cached_object(cache_dir, object_hash, parts)
+                manifest[obj.name] = {
+                    "hash": object_hash,
+                    "meshes": obj_meshes,
+                    "palettes": obj_palettes,
+                    "buffers": [(len(part["index_buffer"]), len(part["vertex_buffer"])) for part in parts],
+                }
+
+        meshes.extend(obj_meshes)
+        palettes.update(obj_palettes)
+        for part in parts:
+            buffers.append({
+                "index_buffer": [{"buffer": part["index_buffer"]}],
+                "vertex_buffer": [{"buffer": part["vertex_buffer"]}],
+            })
+
+    if incremental:
+        trinity_io.write_json(
+            os.path.join(dest_dir, model_name + MANIFEST + JSON),
+            {"version": MANIFEST_VERSION, "objects": manifest},
+        )
+        ## Cache files of objects that changed or are no longer exported
+        kept = set(entry["hash"] + CACHE for entry in manifest.values())
+        for name in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+            if name.endswith(CACHE) and name not in kept:
+                os.remove(os.path.join(cache_dir, name))
+        print("Reused %d of %d objects from the last export" % (reused, len(manifest)))
+
+    ## The trmsh schema has no field for bone palettes, so the skeleton bone
+    ## each local BLEND_INDICES value stands for is written next to the model
+    if palettes:
+        trinity_io.write_json(os.path.join(dest_dir, model_name + PALETTE + JSON), palettes)
+
+    ## Write the final model files straight away, no appenders or flatc needed
+    if settings["binary"] == 1:
+        saved = trinity_io.write_trmbf(
+            os.path.join(dest_dir, model_name + TRMBF),
+            {"unused": 0, "buffers": buffers},
+            settings["dedup"] == 1,
+        )
+        if settings["dedup"] == 1:
+            print("Identical index/vertex buffers stored once, %d bytes saved" % saved)
+        trinity_io.write_trmsh(
+            os.path.join(dest_dir, model_name + TRMSH),
+            {"unk0": 0, "meshes": meshes, "buffer_name": model_name + TRMBF},
+        )
 
     return 0
 
@@ -317,10 +651,16 @@ def write_buffer_data(context, filepath, obj, settings, bone_dict):
 # ExportHelper is a helper class, defines filename and
 # invoke() function which calls the file selector.
 from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, IntProperty
+from bpy.props import StringProperty, BoolProperty, IntProperty, EnumProperty
 from bpy.types import Operator
 
 
+POSITION_FORMATS = (
+    ("RGB_32_FLOAT", "RGB_32_FLOAT", "Full precision, 12 bytes"),
+    ("RGBA_16_FLOAT", "RGBA_16_FLOAT", "Half floats, 8 bytes"),
+)
+
+
 class ExportSomeData(Operator, ExportHelper):
     """This appears in the tooltip of the operator and in the generated docs"""
 
@@ -378,8 +718,59 @@ class ExportSomeData(Operator, ExportHelper):
         default=1,
     )
 
+    position_format: EnumProperty(
+        name="Position Format",
+        items=POSITION_FORMATS,
+        default="RGB_32_FLOAT",
+    )
+
     use_skinning: BoolProperty(name="Use Skinning", default=True)
 
+    use_reference: BoolProperty(
+        name="Use Reference Exporter",
+        default=False,
+    )
+
+    use_weld: BoolProperty(
+        name="Weld Vertices",
+        default=True,
+    )
+
+    use_vcache: BoolProperty(
+        name="Optimize Vertex Cache",
+        default=False,
+    )
+
+    use_split: BoolProperty(
+        name="Split Into UINT16 Submeshes",
+        default=False,
+    )
+
+    use_binary: BoolProperty(
+        name="Write TRMSH/TRMBF",
+        default=True,
+    )
+
+    use_json: BoolProperty(
+        name="Write Debug JSON",
+        default=False,
+    )
+
+    use_incremental: BoolProperty(
+        name="Skip Unchanged Objects",
+        default=False,
+    )
+
+    use_parallel: BoolProperty(
+        name="Build Objects In Parallel",
+        default=False,
+    )
+
+    use_dedup: BoolProperty(
+        name="Share Identical Buffers",
+        default=False,
+    )
+
     def execute(self, context):
         dest_dir = os.path.dirname(self.filepath)
 
@@ -392,21 +783,28 @@ class ExportSomeData(Operator, ExportHelper):
             "color": self.use_color,
             "color_count": self.color_count,
             "skinning": self.use_skinning,
+            "position_format": self.position_format,
+            "reference": self.use_reference,
+            "weld": self.use_weld,
+            "vcache": self.use_vcache,
+            "split": self.use_split,
+            "binary": self.use_binary,
+            "json": self.use_json,
+            "incremental": self.use_incremental,
+            "parallel": self.use_parallel,
+            "dedup": self.use_dedup,
         }
 
-        for obj in bpy.context.selected_objects:
-            write_buffer_data(
-                context,
-                os.path.join(dest_dir, obj.name + TRMBF + self.filename_ext),
-                obj,
-                export_settings,
-            )
-            write_mesh_data(
-                context,
-                os.path.join(dest_dir, obj.name + TRMSH + self.filename_ext),
-                obj,
-                export_settings,
-            )
+        model_name = os.path.splitext(os.path.basename(self.filepath))[0]
+
+        export_objects(
+            context,
+            dest_dir,
+            model_name,
+            bpy.context.selected_objects,
+            export_settings,
+            {},
+        )
 
         return {"FINISHED"}
 
@@ -429,7 +827,9 @@ def unregister():
 
 if __name__ == "__main__":
     register()
-    bpy.ops.export_test.some_data("INVOKE_DEFAULT")
+    ## No file selector without a UI, batch_export.py drives background runs
+    if not bpy.app.background:
+        bpy.ops.export_test.some_data("INVOKE_DEFAULT")
     # unregister()
 
 import os
@@ -497,7 +897,58 @@ class FileInputDialogOperator(bpy.types.Operator):
         default=1,
     )
 
+    position_format: EnumProperty(
+        name="Position Format",
+        items=POSITION_FORMATS,
+        default="RGB_32_FLOAT",
+    )
+
     use_skinning: BoolProperty(name="Use Skinning", default=True)
+
+    use_reference: BoolProperty(
+        name="Use Reference Exporter",
+        default=False,
+    )
+
+    use_weld: BoolProperty(
+        name="Weld Vertices",
+        default=True,
+    )
+
+    use_vcache: BoolProperty(
+        name="Optimize Vertex Cache",
+        default=False,
+    )
+
+    use_split: BoolProperty(
+        name="Split Into UINT16 Submeshes",
+        default=False,
+    )
+
+    use_binary: BoolProperty(
+        name="Write TRMSH/TRMBF",
+        default=True,
+    )
+
+    use_json: BoolProperty(
+        name="Write Debug JSON",
+        default=False,
+    )
+
+    use_incremental: BoolProperty(
+        name="Skip Unchanged Objects",
+        default=False,
+    )
+
+    use_parallel: BoolProperty(
+        name="Build Objects In Parallel",
+        default=False,
+    )
+
+    use_dedup: BoolProperty(
+        name="Share Identical Buffers",
+        default=False,
+    )
     filepath: bpy.props.StringProperty(subtype="FILE_PATH")
 
     def execute(self, context):
@@ -517,23 +968,29 @@ class FileInputDialogOperator(bpy.types.Operator):
             "color": self.use_color,
             "color_count": self.color_count,
             "skinning": self.use_skinning,
+            "position_format": self.position_format,
+            "reference": self.use_reference,
+            "weld": self.use_weld,
+            "vcache": self.use_vcache,
+            "split": self.use_split,
+            "binary": self.use_binary,
+            "json": self.use_json,
+            "incremental": self.use_incremental,
+            "parallel": self.use_parallel,
+            "dedup": self.use_dedup,
         }
 
-        for obj in bpy.context.selected_objects:
-            write_buffer_data(
-                context,
-                os.path.join(dest_dir, obj.name + TRMBF + self.filename_ext),
-                obj,
-                export_settings,
-                bone_dict
-            )
-            write_mesh_data(
-                context,
-                os.path.join(dest_dir, obj.name + TRMSH + self.filename_ext),
-                obj,
-                export_settings,
-            )        
-        
+        model_name = os.path.splitext(os.path.basename(self.filepath))[0]
+
+        export_objects(
+            context,
+            dest_dir,
+            model_name,
+            bpy.context.selected_objects,
+            export_settings,
+            bone_dict,
+        )
+
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -543,192 +1000,9 @@ class FileInputDialogOperator(bpy.types.Operator):
 bpy.utils.register_class(FileInputDialogOperator)
 
 # Open the file input dialog
-bpy.ops.object.file_input_dialog('INVOKE_DEFAULT')
-
-def readbyte(file):
-    return int.from_bytes(file.read(1), byteorder='little')
-
-def readshort(file):
-    return int.from_bytes(file.read(2), byteorder='little')
-
-# SIGNED!!!!
-def readlong(file):
-    bytes_data = file.read(4)
-    return int.from_bytes(bytes_data, byteorder='little', signed=True)
-
-def readfloat(file):
-    return struct.unpack('<f', file.read(4))[0]
-
-def readhalffloat(file):
-    return struct.unpack('<e', file.read(2))[0]
-
-def readfixedstring(file, length):
-    bytes_data = file.read(length)
-    return bytes_data.decode('utf-8')
-
-def fseek(file, offset):
-    file.seek(offset)
-
-def ftell(file):
-    return file.tell()
-
-def fclose(file):
-    file.close()
-    
-def fopen(file):
-    file.open()
-
+if __name__ == "__main__" and not bpy.app.background:
+    bpy.ops.object.file_input_dialog('INVOKE_DEFAULT')
 
 def readtrskl(trsklfile):
-    trskl = open(trsklfile, "rb")
-    bone_array = []
-    bone_id_map = {}
-    bone_rig_array = []
-    trskl_bone_adjust = 0
-    print("Parsing TRSKL...")
-    trskl_file_start = readlong(trskl)
-    fseek(trskl, trskl_file_start)
-    trskl_struct = ftell(trskl) - readlong(trskl); fseek(trskl, trskl_struct)
-    trskl_struct_len = readshort(trskl)
-    
-    if trskl_struct_len == 0x000C:
-        trskl_struct_section_len = readshort(trskl)
-        trskl_struct_start = readshort(trskl)
-        trskl_struct_bone = readshort(trskl)
-        trskl_struct_b = readshort(trskl)
-        trskl_struct_c = readshort(trskl)
-        trskl_struct_bone_adjust = 0
-    elif trskl_struct_len == 0x000E:
-        trskl_struct_section_len = readshort(trskl)
-        trskl_struct_start = readshort(trskl)
-        trskl_struct_bone = readshort(trskl)
-        trskl_struct_b = readshort(trskl)
-        trskl_struct_c = readshort(trskl)
-        trskl_struct_bone_adjust = readshort(trskl)
-    else:
-        raise AssertionError("Unexpected TRSKL header struct length!")
-    
-    if trskl_struct_bone_adjust != 0:
-        fseek(trskl, trskl_file_start + trskl_struct_bone_adjust)
-        trskl_bone_adjust = readlong(trskl)
-        print(f"Mesh node IDs start at {trskl_bone_adjust}")
-    
-    if trskl_struct_bone != 0:
-        fseek(trskl, trskl_file_start + trskl_struct_bone)
-        trskl_bone_start = ftell(trskl) + readlong(trskl)
-        fseek(trskl, trskl_bone_start)
-        bone_count = readlong(trskl)
-    
-        for x in range(bone_count):
-            bone_offset = ftell(trskl) + readlong(trskl)
-            bone_ret = ftell(trskl)
-            fseek(trskl, bone_offset)
-            trskl_bone_struct = ftell(trskl) - readlong(trskl)
-            fseek(trskl, trskl_bone_struct)
-            trskl_bone_struct_len = readshort(trskl)
-    
-            if trskl_bone_struct_len == 0x0012:
-                trskl_bone_struct_ptr_section_len = readshort(trskl)
-                trskl_bone_struct_ptr_string = readshort(trskl)
-                trskl_bone_struct_ptr_bone = readshort(trskl)
-                trskl_bone_struct_ptr_c = readshort(trskl)
-                trskl_bone_struct_ptr_d = readshort(trskl)
-                trskl_bone_struct_ptr_parent = readshort(trskl)
-                trskl_bone_struct_ptr_rig_id = readshort(trskl)
-                trskl_bone_struct_ptr_bone_merge = readshort(trskl)
-                trskl_bone_struct_ptr_h = 0
-            elif trskl_bone_struct_len == 0x0014:
-                trskl_bone_struct_ptr_section_len = readshort(trskl)
-                trskl_bone_struct_ptr_string = readshort(trskl)
-                trskl_bone_struct_ptr_bone = readshort(trskl)
-                trskl_bone_struct_ptr_c = readshort(trskl)
-                trskl_bone_struct_ptr_d = readshort(trskl)
-                trskl_bone_struct_ptr_parent = readshort(trskl)
-                trskl_bone_struct_ptr_rig_id = readshort(trskl)
-                trskl_bone_struct_ptr_bone_merge = readshort(trskl)
-                trskl_bone_struct_ptr_h = readshort(trskl)
-            else:
-                trskl_bone_struct_ptr_section_len = readshort(trskl)
-                trskl_bone_struct_ptr_string = readshort(trskl)
-                trskl_bone_struct_ptr_bone = readshort(trskl)
-                trskl_bone_struct_ptr_c = readshort(trskl)
-                trskl_bone_struct_ptr_d = readshort(trskl)
-                trskl_bone_struct_ptr_parent = readshort(trskl)
-                trskl_bone_struct_ptr_rig_id = readshort(trskl)
-                trskl_bone_struct_ptr_bone_merge = readshort(trskl)
-                trskl_bone_struct_ptr_h = readshort(trskl)
-    
-            if trskl_bone_struct_ptr_bone_merge != 0:
-                fseek(trskl, bone_offset + trskl_bone_struct_ptr_bone_merge)
-                bone_merge_start = ftell(trskl) + readlong(trskl)
-                fseek(trskl, bone_merge_start)
-                bone_merge_string_len = readlong(trskl)
-                if bone_merge_string_len != 0:
-                    bone_merge_string = readfixedstring(trskl, bone_merge_string_len)
-                else:
-                    bone_merge_string = ""
-    
-            if trskl_bone_struct_ptr_bone != 0:
-                fseek(trskl, bone_offset + trskl_bone_struct_ptr_bone)
-                bone_pos_start = ftell(trskl) + readlong(trskl)
-                fseek(trskl, bone_pos_start)
-                bone_pos_struct = ftell(trskl) - readlong(trskl)
-                fseek(trskl, bone_pos_struct)
-                bone_pos_struct_len = readshort(trskl)
-    
-                if bone_pos_struct_len != 0x000A:
-                    raise AssertionError("Unexpected bone position struct length!")
-    
-                bone_pos_struct_section_len = readshort(trskl)
-                bone_pos_struct_ptr_scl = readshort(trskl)
-                bone_pos_struct_ptr_rot = readshort(trskl)
-                bone_pos_struct_ptr_trs = readshort(trskl)
-    
-                fseek(trskl, bone_pos_start + bone_pos_struct_ptr_trs)
-                bone_tx = readfloat(trskl)
-                bone_ty = readfloat(trskl)
-                bone_tz = readfloat(trskl)
-    
-                fseek(trskl, bone_pos_start + bone_pos_struct_ptr_rot)
-                bone_rx = readfloat(trskl)
-                bone_ry = readfloat(trskl)
-                bone_rz = readfloat(trskl)
-    
-                fseek(trskl, bone_pos_start + bone_pos_struct_ptr_scl)
-                bone_sx = readfloat(trskl)
-                bone_sy = readfloat(trskl)
-                bone_sz = readfloat(trskl)
-    
-                if trskl_bone_struct_ptr_string != 0:
-                    fseek(trskl, bone_offset + trskl_bone_struct_ptr_string)
-                    bone_string_start = ftell(trskl) + readlong(trskl)
-                    fseek(trskl, bone_string_start)
-                    bone_str_len = readlong(trskl)
-                    bone_name = readfixedstring(trskl, bone_str_len)
-    
-                if trskl_bone_struct_ptr_parent != 0x00:
-                    fseek(trskl, bone_offset + trskl_bone_struct_ptr_parent)
-                    bone_parent = readlong(trskl)
-                else:
-                    bone_parent = 0
-                
-                if str(trskl_bone_struct_ptr_rig_id) == "-1":
-                    trskl_bone_struct_ptr_rig_id = 99
-                if trskl_bone_struct_ptr_rig_id != 0:
-                    fseek(trskl, bone_offset + trskl_bone_struct_ptr_rig_id)
-                    bone_rig_id = readlong(trskl) + trskl_bone_adjust
-    
-                    while len(bone_rig_array) <= bone_rig_id:
-                        bone_rig_array.append("")
-                    bone_rig_array[bone_rig_id] = bone_name
-                    bone_id_map[bone_name] = bone_rig_id
-    
-            fseek(trskl, bone_ret)
-    
-    fclose(trskl)
-    
-    bone_dict = {}
-    for bone_name, bone_rig_id in bone_id_map.items():
-        bone_dict[bone_name] = bone_rig_id
-   
-    return bone_dict
\ No newline at end of file
+    ## Bone name -> rig ID, trinity_io.read_trskl has the full bone table
+    return trinity_io.get_trskl_bone_dict(trinity_io.read_trskl(trsklfile))
@@ -0,0 +1,84 @@
+import math
+
+import numpy as np
+
+## Bounds of the exported vertex positions, for the trmsh bounds and clip_sphere.
+## Everything works on (N, 3) float64 arrays of the positions as they are stored.
+
+## Passes of the sphere refinement, each one is a single pass over the points
+SPHERE_REFINE_ITERATIONS = 64
+## Ritter growth steps before the radius is just set to the farthest point
+SPHERE_GROW_ITERATIONS = 256
+
+
+def get_aabb(positions):
+    ## Per component min/max, zero for a mesh without vertices
+    if len(positions) == 0:
+        return np.zeros(3), np.zeros(3)
+    return positions.min(axis=0), positions.max(axis=0)
+
+
+def get_distances(positions, center):
+    offsets = positions - center
+    return np.sqrt(np.einsum("ij,ij->i", offsets, offsets))
+
+
+def get_ritter_sphere(positions):
+    ## Ritter: the sphere through two far apart points, then grown towards the
+    ## farthest point outside it until every point is inside
+    start = positions[np.argmax(get_distances(positions, positions[0]))]
+    end = positions[np.argmax(get_distances(positions, start))]
+    center = (start + end) / 2.0
+    radius = np.linalg.norm(end - start) / 2.0
+
+    for i in range(SPHERE_GROW_ITERATIONS):
+        distances = get_distances(positions, center)
+        farthest = np.argmax(distances)
+        distance = distances[farthest]
+        if distance <= radius:
+            break
+        new_radius = (radius + distance) / 2.0
+        center = center + (positions[farthest] - center) * ((distance - new_radius) / distance)
+        radius = new_radius
+
+    return center, get_distances(positions, center).max()
+
+
+def refine_sphere(positions, center, radius):
+    ## Badoiu-Clarkson: the center keeps stepping towards the farthest point with
+    ## shrinking steps, which converges on the minimal sphere's center. The
+    ## smallest sphere seen on the way is kept, so it never ends up worse.
+    best_center, best_radius = center, radius
+    for i in range(SPHERE_REFINE_ITERATIONS):
+        distances = get_distances(positions, center)
+        farthest = np.argmax(distances)
+        if distances[farthest] < best_radius:
+            best_center, best_radius = center, distances[farthest]
+        center = center + (positions[farthest] - center) / (i + 2)
+    return best_center, best_radius
+
+
+def get_bounding_sphere(positions):
+    ## Near minimal sphere around the points. The center is rounded the same way
+    ## the json is and the radius measured from that, rounded up, so every
+    ## exported vertex stays inside.
+    if len(positions) == 0:
+        return np.zeros(3), 0.0
+    center, radius = refine_sphere(positions, *get_ritter_sphere(positions))
+    center = np.round(center, 6)
+    radius = get_distances(positions, center).max()
+    return center, math.ceil(float(radius) * 1e6) / 1e6
+
+
+def get_material_bounds(positions, tris, material_ranges):
+    ## AABB and sphere of the vertices each (poly_offset, poly_count) range uses,
+    ## None for empty ranges
+    corners = tris.reshape(-1)
+    bounds = []
+    for poly_offset, poly_count in material_ranges:
+        if poly_count == 0:
+            bounds.append(None)
+            continue
+        used = positions[np.unique(corners[poly_offset:poly_offset + poly_count])]
+        bounds.append((get_aabb(used), get_bounding_sphere(used)))
+    return bounds
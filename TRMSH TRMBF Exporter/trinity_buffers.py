@@ -0,0 +1,726 @@
+import hashlib
+import multiprocessing
+import struct
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+
+## FIFO size used to order and measure triangles for the post-transform cache
+VERTEX_CACHE_SIZE = 16
+
+## BLEND_INDICES are bytes, so one mesh can reference this many bones
+BONE_PALETTE_SIZE = 256
+
+## Influences under this share of a vertex's total weight are dropped
+BLEND_WEIGHT_EPSILON = 1.0 / 0xFFFF
+
+## Memory budget of the derived attributes kept between exports
+DERIVED_CACHE_BYTES = 256 << 20
+
+## Array based buffer building for operator_buffer_export.py
+## Nothing in here touches bpy, everything works on the arrays that
+## gather_mesh_arrays pulls out of the mesh with foreach_get.
+
+
+def get_content_hash(arrays):
+    ## blake2b over the given arrays, shapes and types included
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(("%s%s" % (array.dtype.str, array.shape)).encode("ascii"))
+        digest.update(array)
+    return digest.hexdigest()
+
+
+class DerivedAttributeCache:
+    ## Arrays derived from a mesh (tangents, ...) keyed by the mesh, a content
+    ## hash of everything they depend on and the attribute name. The module stays
+    ## loaded between runs of the script, so repeated exports of an unchanged
+    ## mesh in one Blender session reuse them. Least recently used entries are
+    ## dropped once the stored arrays pass max_bytes.
+
+    def __init__(self, max_bytes=DERIVED_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, mesh_key, content_hash, name, compute):
+        key = (mesh_key, name)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == content_hash:
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        value = compute()
+        value.setflags(write=False)
+        self.discard(key)
+        if value.nbytes <= self.max_bytes:
+            self.entries[key] = (content_hash, value)
+            self.size += value.nbytes
+            while self.size > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+        return value
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1].nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+derived_cache = DerivedAttributeCache()
+
+
+def get_polygon_loop_order(loop_start, loop_total):
+    ## Loop indices in the order "for poly in mesh.polygons: for loop in poly.loop_indices" visits them
+    total = int(loop_total.sum())
+    poly_first = np.repeat(np.cumsum(loop_total) - loop_total, loop_total)
+    return np.repeat(loop_start, loop_total) + (np.arange(total) - poly_first)
+
+
+def get_vertex_source_loops(loop_vertex, loop_order, vert_count):
+    ## The reference exporter stores vert_data[vidx] for every loop it visits,
+    ## so the last visited loop of a vertex is the one that ends up in the buffer
+    last = np.full(vert_count, -1, dtype=np.int64)
+    np.maximum.at(last, loop_vertex[loop_order], np.arange(len(loop_order)))
+    source = np.zeros(vert_count, dtype=np.int64)
+    used = last >= 0
+    source[used] = loop_order[last[used]]
+    return source
+
+
+def get_triangle_loops(loop_start):
+    return loop_start[:, None] + np.arange(3)
+
+
+def get_blend_arrays(group_counts, group_bones, weights, influences=4):
+    ## Flat per vertex (bone, weight) lists into fixed width index/weight arrays.
+    ## Every vertex keeps its strongest mapped influences, heaviest first, ties
+    ## stay in Blender's group order. group_bones is -1 for groups without a bone.
+    vert_count = len(group_counts)
+    owner = np.repeat(np.arange(vert_count), group_counts)
+    mapped = (group_bones >= 0) & (weights > 0)
+    owner = owner[mapped]
+    bones = group_bones[mapped]
+    weights = weights[mapped]
+
+    order = np.lexsort((-weights, owner))
+    owner = owner[order]
+    mapped_counts = np.bincount(owner, minlength=vert_count)
+    slot = np.arange(len(owner)) - np.repeat(np.cumsum(mapped_counts) - mapped_counts, mapped_counts)
+    keep = slot < influences
+
+    blend_indices = np.zeros((vert_count, influences), dtype=np.int64)
+    blend_weights = np.zeros((vert_count, influences), dtype=np.float32)
+    blend_indices[owner[keep], slot[keep]] = bones[order][keep]
+    blend_weights[owner[keep], slot[keep]] = weights[order][keep]
+    return blend_indices, normalize_blend_weights(blend_indices, blend_weights)
+
+
+def normalize_blend_weights(blend_indices, blend_weights):
+    ## Drops influences too small to survive quantization, then scales the
+    ## rest to sum to one. The strongest influence is always kept.
+    weights = blend_weights.astype(np.float64)
+    total = weights.sum(axis=1, keepdims=True)
+    tiny = weights < total * BLEND_WEIGHT_EPSILON
+    tiny[:, 0] = False
+    weights[tiny] = 0.0
+    blend_indices[tiny] = 0
+    total = weights.sum(axis=1, keepdims=True)
+    np.divide(weights, total, out=weights, where=total > 0)
+    return weights
+
+
+def quantize_blend_weights(weights):
+    ## RGBA_16_UNORM weights by largest remainder: every row is floored, then the
+    ## units lost to flooring go to the entries with the largest remainders, so
+    ## each skinned vertex sums to exactly 0xFFFF
+    scaled = weights.astype(np.float64) * 0xFFFF
+    quantized = np.floor(scaled)
+    deficit = np.where(weights.sum(axis=1) > 0, 0xFFFF - quantized.sum(axis=1), 0)
+    remainder = np.where(weights > 0, scaled - quantized, -1.0)
+    rank = np.argsort(np.argsort(-remainder, axis=1, kind="stable"), axis=1)
+    quantized += rank < deficit[:, None]
+    return quantized.astype("<u2")
+
+
+def group_triangles_by_material(material_index, material_count):
+    ## Counting sort of the triangles by material slot: the stable order keeps
+    ## Blender's polygon order inside a slot, and each slot becomes one
+    ## contiguous (poly_offset, poly_count) range of the index buffer
+    counts = np.bincount(material_index, minlength=material_count)
+    order = np.argsort(material_index, kind="stable")
+    offsets = np.cumsum(counts) - counts
+    material_ranges = [(int(offset) * 3, int(count) * 3) for offset, count in zip(offsets, counts)]
+    return order, material_ranges
+
+
+## Vertex attribute type -> (numpy element type, component count, struct format)
+VERTEX_TYPES = {
+    "RGB_32_FLOAT": ("<f4", 3, "<3f"),
+    "RG_32_FLOAT": ("<f4", 2, "<2f"),
+    "RGBA_16_FLOAT": ("<f2", 4, "<4e"),
+    "RGBA_16_UNORM": ("<u2", 4, "<4H"),
+    "RGBA_8_UNORM": ("u1", 4, "<4B"),
+    "RGBA_8_UNSIGNED": ("u1", 4, "<4B"),
+}
+
+## Formats an attribute can be exported as, the first one is the default.
+## Only types of the Trinity Type enum are offered, so UVs stay RG_32_FLOAT.
+## Normals and tangents stay RGBA_16_FLOAT, a UNORM type would be read back
+## in [0, 1] and nothing in the trmsh says they should be expanded.
+VERTEX_FORMATS = {
+    "POSITION": ("RGB_32_FLOAT", "RGBA_16_FLOAT"),
+}
+
+## Types that hold the exported values exactly, the others get an error report
+EXACT_TYPES = ("RGB_32_FLOAT", "RG_32_FLOAT", "RGBA_8_UNSIGNED")
+
+
+def get_field_name(attr):
+    return "%s_%d" % (attr["attribute"], attr["attribute_layer"])
+
+
+def get_vertex_format(settings, attribute):
+    vtx_type = settings[attribute.lower() + "_format"]
+    if vtx_type not in VERTEX_FORMATS[attribute]:
+        raise ValueError("%s can't be exported as %s." % (attribute, vtx_type))
+    return vtx_type
+
+
+def uses_default_formats(settings):
+    return all(get_vertex_format(settings, attribute) == formats[0] for attribute, formats in VERTEX_FORMATS.items())
+
+
+def compile_vertex_layout(settings):
+    ## Turns the export settings into the single description of a vertex
+    ## that write_mesh_data declares and write_buffer_data fills
+    elements = [("POSITION", 0, get_vertex_format(settings, "POSITION"))]
+    if settings["normal"] == 1:
+        elements.append(("NORMAL", 0, "RGBA_16_FLOAT"))
+    if settings["tangent"] == 1:
+        elements.append(("TANGENT", 0, "RGBA_16_FLOAT"))
+    if settings["uv"] == 1:
+        for i in range(settings["uv_count"]):
+            elements.append(("TEXCOORD", i, "RG_32_FLOAT"))
+    if settings["color"] == 1:
+        for i in range(settings["color_count"]):
+            elements.append(("COLOR", i, "RGBA_8_UNORM"))
+    if settings["skinning"] == 1:
+        elements.append(("BLEND_INDICES", 0, "RGBA_8_UNSIGNED"))
+        elements.append(("BLEND_WEIGHTS", 0, "RGBA_16_UNORM"))
+
+    attrs = []
+    names = []
+    formats = []
+    packers = {}
+    vtx_size = 0
+    for attribute, layer, vtx_type in elements:
+        elem, count, fmt = VERTEX_TYPES[vtx_type]
+        attr = {
+            "attr_0": 0,
+            "attribute": attribute,
+            "attribute_layer": layer,
+            "type": vtx_type,
+            "position": vtx_size,
+        }
+        attrs.append(attr)
+        names.append(get_field_name(attr))
+        formats.append((elem, count))
+        packers[get_field_name(attr)] = struct.Struct(fmt)
+        vtx_size += packers[get_field_name(attr)].size
+
+    dtype = np.dtype({
+        "names": names,
+        "formats": formats,
+        "offsets": [attr["position"] for attr in attrs],
+        "itemsize": vtx_size,
+    })
+
+    return {
+        "attrs": attrs,
+        "size": vtx_size,
+        "dtype": dtype,
+        "packers": packers,
+    }
+
+
+def to_unorm8(values):
+    ## Clamped and rounded to the nearest step, colors come in as floats
+    return np.rint(np.clip(values.astype(np.float64), 0.0, 1.0) * 0xFF).astype(np.uint8)
+
+
+def write_vertex_field(verts, attr, values):
+    name = get_field_name(attr)
+    if attr["type"] == "RGBA_16_UNORM":
+        ## Only the blend weights are written as RGBA_16_UNORM
+        values = quantize_blend_weights(values)
+    elif attr["type"] == "RGBA_8_UNORM":
+        values = to_unorm8(values)
+    elif attr["type"] == "RGBA_8_UNSIGNED":
+        if values.size and (values.min() < 0 or values.max() > 0xFF):
+            raise ValueError("%s values must fit in an unsigned byte." % name)
+    if values.shape[1] == verts[name].shape[1]:
+        verts[name] = values
+    else:
+        verts[name][:, :values.shape[1]] = values
+        if attr["attribute"] == "POSITION":
+            ## Positions are points, w is 1.0
+            verts[name][:, values.shape[1]:] = 1.0
+
+
+def read_vertex_field(verts, attr):
+    ## The values a field decodes to, as float64
+    values = verts[get_field_name(attr)].astype(np.float64)
+    if attr["type"] == "RGBA_16_UNORM":
+        values /= 0xFFFF
+    elif attr["type"] == "RGBA_8_UNORM":
+        values /= 0xFF
+    return values
+
+
+def get_quantization_error(verts, attr, values):
+    ## Max and mean absolute difference between the values and what was stored
+    stored = read_vertex_field(verts, attr)[:, :values.shape[1]]
+    error = np.abs(stored - values.astype(np.float64))
+    return float(error.max()), float(error.mean())
+
+
+def get_vertex_columns(arrays, loops, verts):
+    ## Values by layout field name for the given loops and their vertices,
+    ## attributes without data stay zeroed
+    columns = {"POSITION_0": arrays["co"][verts]}
+    if "normal" in arrays:
+        columns["NORMAL_0"] = arrays["normal"][loops]
+    if "tangent" in arrays:
+        columns["TANGENT_0"] = arrays["tangent"][loops]
+    ## UVs and colors are (layers, loops, n), one TEXCOORD/COLOR field per layer
+    for layer, uv in enumerate(arrays.get("uv", ())):
+        columns["TEXCOORD_%d" % layer] = uv[loops]
+    for layer, color in enumerate(arrays.get("color", ())):
+        columns["COLOR_%d" % layer] = color[loops]
+    if "blend_indices" in arrays:
+        columns["BLEND_INDICES_0"] = arrays["blend_indices"][verts]
+        columns["BLEND_WEIGHTS_0"] = arrays["blend_weights"][verts]
+    return columns
+
+
+def build_vertex_records(layout, count, columns):
+    ## One zeroed record per vertex, each attribute is written into its strided field
+    records = np.zeros(count, dtype=layout["dtype"])
+    for attr in layout["attrs"]:
+        name = get_field_name(attr)
+        if name in columns:
+            write_vertex_field(records, attr, columns[name])
+            if attr["type"] not in EXACT_TYPES and count:
+                max_error, mean_error = get_quantization_error(records, attr, columns[name])
+                print("%s as %s: max error %.6g, mean error %.6g" % (name, attr["type"], max_error, mean_error))
+    return records
+
+
+def weld_vertex_records(records, extra=None):
+    ## Loops whose packed vertex bytes (plus any extra per loop values) are
+    ## identical become one vertex. Unique vertices keep the order of their
+    ## first loop, returns the loop each one comes from and the loop -> vertex map.
+    if len(records) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    rows = records.view(np.uint8).reshape(len(records), -1)
+    if extra is not None:
+        rows = np.concatenate((rows, extra.reshape(len(records), -1).view(np.uint8)), axis=1)
+    keys = np.ascontiguousarray(rows).view(np.dtype((np.void, rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    rank = np.argsort(first, kind="stable")
+    remap = np.empty(len(rank), dtype=np.int64)
+    remap[rank] = np.arange(len(rank))
+    return first[rank], remap[inverse.ravel()]
+
+
+def get_vertex_triangles(tris, vert_count):
+    ## Triangles using each vertex, as offsets into one flat list
+    corners = tris.ravel()
+    order = np.argsort(corners, kind="stable")
+    counts = np.bincount(corners, minlength=vert_count)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return offsets.tolist(), (order // 3).tolist(), counts.tolist()
+
+
+def tipsify(tris, vert_count, cache_size=VERTEX_CACHE_SIZE):
+    ## Tipsify (Sander et al. 2007): fan around a vertex that is still in the
+    ## cache, fall back to the dead end stack and then to the next live vertex
+    offsets, adjacency, live = get_vertex_triangles(tris, vert_count)
+    tri_list = tris.tolist()
+    stamps = [-cache_size - 1] * vert_count
+    emitted = [False] * len(tri_list)
+    dead_end = []
+    out = []
+    time = cache_size + 1
+    cursor = 0
+    fan = int(tris[0, 0]) if len(tri_list) else -1
+
+    while fan >= 0:
+        candidates = []
+        for t in adjacency[offsets[fan]:offsets[fan + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            out.append(t)
+            for v in tri_list[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - stamps[v] > cache_size:
+                    stamps[v] = time
+                    time += 1
+
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - stamps[v] + 2 * live[v] <= cache_size:
+                    priority = time - stamps[v]
+                if priority > best:
+                    best = priority
+                    fan = v
+
+        if fan < 0:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fan = v
+                    break
+        if fan < 0:
+            while cursor < vert_count:
+                if live[cursor] > 0:
+                    fan = cursor
+                    break
+                cursor += 1
+
+    return tris[np.array(out, dtype=np.int64)] if out else tris
+
+
+def get_cache_stats(tris, cache_size=VERTEX_CACHE_SIZE):
+    ## ACMR (misses per triangle) and ATVR (misses per used vertex) of a FIFO cache
+    stamps = {}
+    misses = 0
+    for v in tris.ravel().tolist():
+        if misses - stamps.get(v, -cache_size - 1) > cache_size:
+            stamps[v] = misses
+            misses += 1
+    return misses / max(len(tris), 1), misses / max(len(stamps), 1)
+
+
+def optimize_vertex_cache(tris, verts, material_ranges):
+    ## Reorder the triangles inside every material range, then renumber the
+    ## vertices in the order the new index buffer first uses them
+    tris = tris.copy()
+    for offset, count in material_ranges:
+        if count:
+            first, last = offset // 3, (offset + count) // 3
+            tris[first:last] = tipsify(tris[first:last], len(verts))
+
+    used, first_use = np.unique(tris.ravel(), return_index=True)
+    fetch_order = used[np.argsort(first_use, kind="stable")]
+    unused = np.setdiff1d(np.arange(len(verts)), used)
+    fetch_order = np.concatenate((fetch_order, unused))
+    remap = np.empty(len(verts), dtype=np.int64)
+    remap[fetch_order] = np.arange(len(verts))
+    return remap[tris], verts[fetch_order]
+
+
+def get_vertex_components(tris, vert_count):
+    ## Connected components over shared vertices: min label propagation
+    ## with pointer jumping, returns one label per triangle
+    labels = np.arange(vert_count)
+    while True:
+        tri_labels = labels[tris].min(axis=1)
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, tris.ravel(), np.repeat(tri_labels, 3))
+        while True:
+            jumped = new_labels[new_labels]
+            if np.array_equal(jumped, new_labels):
+                break
+            new_labels = jumped
+        if np.array_equal(new_labels, labels):
+            return labels[tris[:, 0]]
+        labels = new_labels
+
+
+def split_triangles(tris, tri_materials, positions, limit=0x10000):
+    ## Packs whole connected pieces of each material into submeshes of at most
+    ## limit vertices, only pieces that are too big on their own get cut per
+    ## triangle, sweeping along their longest axis to keep the cuts short
+    vert_count = len(positions)
+    components = get_vertex_components(tris, vert_count)
+    order = np.lexsort((components, tri_materials))
+    keys = np.stack((tri_materials[order], components[order]), axis=1)
+    starts = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+    groups = np.split(order, starts)
+
+    pieces = []
+    current = []
+    marked = np.zeros(vert_count, dtype=bool)
+    used = 0
+
+    for group in groups:
+        group_verts = np.unique(tris[group])
+        new = int(np.count_nonzero(~marked[group_verts]))
+        if current and used + new > limit:
+            pieces.append(np.concatenate(current))
+            current = []
+            marked[:] = False
+            used = 0
+            new = len(group_verts)
+        if used + new <= limit:
+            current.append(group)
+            marked[group_verts] = True
+            used += new
+            continue
+
+        centers = positions[tris[group]].mean(axis=1)
+        axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+        group = group[np.argsort(centers[:, axis], kind="stable")]
+        for t in group.tolist():
+            tri_new = [v for v in set(tris[t].tolist()) if not marked[v]]
+            if used + len(tri_new) > limit:
+                pieces.append(np.concatenate(current))
+                current = []
+                marked[:] = False
+                used = 0
+                tri_new = set(tris[t].tolist())
+            current.append(np.array([t]))
+            marked[list(tri_new)] = True
+            used += len(tri_new)
+
+    if current:
+        pieces.append(np.concatenate(current))
+    return pieces
+
+
+def get_local_vertices(tris):
+    ## Keeps only the vertices the triangles use, numbered by first use
+    used, first_use, inverse = np.unique(tris.ravel(), return_index=True, return_inverse=True)
+    rank = np.argsort(first_use, kind="stable")
+    remap = np.empty(len(used), dtype=np.int64)
+    remap[rank] = np.arange(len(used))
+    return remap[inverse.ravel()].reshape(tris.shape), used[rank]
+
+
+def partition_bone_palettes(tri_bones, palette_size=BONE_PALETTE_SIZE):
+    ## Greedy set cover: a palette takes every triangle whose bones it already
+    ## has, then grows by the triangle that needs the fewest new bones until
+    ## nothing else fits. tri_bones holds each triangle's bones, -1 when unused.
+    sentinel = int(tri_bones.max()) + 1
+    tri_bones = np.sort(np.where(tri_bones < 0, sentinel, tri_bones), axis=1)
+    tri_bones[:, 1:][tri_bones[:, 1:] == tri_bones[:, :-1]] = sentinel
+
+    remaining = np.ones(len(tri_bones), dtype=bool)
+    pieces = []
+    palettes = []
+    while remaining.any():
+        in_palette = np.zeros(sentinel + 1, dtype=bool)
+        in_palette[sentinel] = True
+        size = 0
+        members = np.zeros(len(tri_bones), dtype=bool)
+        candidates = np.flatnonzero(remaining)
+        while len(candidates):
+            need = np.count_nonzero(~in_palette[tri_bones[candidates]], axis=1)
+            members[candidates[need == 0]] = True
+            candidates = candidates[need > 0]
+            need = need[need > 0]
+            if not len(candidates) or size + need.min() > palette_size:
+                break
+            best = candidates[np.argmin(need)]
+            in_palette[tri_bones[best]] = True
+            size = np.count_nonzero(in_palette) - 1
+
+        remaining &= ~members
+        pieces.append(np.flatnonzero(members))
+        palettes.append(np.flatnonzero(in_palette[:sentinel]))
+    return pieces, palettes
+
+
+def build_mesh_parts(arrays, layout, settings):
+    vert_count = len(arrays["co"])
+    loop_count = len(arrays["loop_vertex"])
+
+    order, material_ranges = group_triangles_by_material(arrays["material_index"], arrays["material_count"])
+    tri_loops = get_triangle_loops(arrays["loop_start"][order])
+    tri_materials = arrays["material_index"][order]
+
+    ## Bone IDs past a byte go through per submesh palettes, the real IDs are
+    ## kept aside and only written into the records once they are remapped
+    use_palettes = False
+    if "blend_indices" in arrays and len(tri_loops):
+        use_palettes = arrays["blend_indices"].max() >= BONE_PALETTE_SIZE
+
+    if settings["weld"] == 1:
+        ## Every loop keeps its own normal/tangent/UV, then identical ones are merged
+        columns = get_vertex_columns(arrays, slice(None), arrays["loop_vertex"])
+        bone_ids = columns.pop("BLEND_INDICES_0") if use_palettes else None
+        records = build_vertex_records(layout, loop_count, columns)
+        source, loop_ids = weld_vertex_records(records, bone_ids)
+        verts = records[source]
+        if use_palettes:
+            bone_ids = bone_ids[source]
+        print("Welded %d loops into %d vertices (%.1f%% of the loops, %d Blender vertices)" % (
+            loop_count, len(verts), 100.0 * len(verts) / max(loop_count, 1), vert_count))
+    else:
+        ## Same as the reference exporter, the last loop visited decides a vertex's attributes
+        loop_order = get_polygon_loop_order(arrays["loop_start"], arrays["loop_total"])
+        source = get_vertex_source_loops(arrays["loop_vertex"], loop_order, vert_count)
+        columns = get_vertex_columns(arrays, source, slice(None))
+        bone_ids = columns.pop("BLEND_INDICES_0") if use_palettes else None
+        verts = build_vertex_records(layout, vert_count, columns)
+        loop_ids = arrays["loop_vertex"]
+
+    tris = loop_ids[tri_loops]
+
+    pieces = [None]
+    palettes = [None]
+    if use_palettes:
+        vert_bones = np.where(verts["BLEND_WEIGHTS_0"] > 0, bone_ids, -1)
+        pieces, palettes = partition_bone_palettes(vert_bones[tris].reshape(len(tris), -1))
+        print("Split %d bones into %d palettes of up to %d bones" % (
+            len(np.unique(vert_bones[vert_bones >= 0])), len(palettes), BONE_PALETTE_SIZE))
+
+    if settings["split"] == 1:
+        positions = verts["POSITION_0"][:, :3].astype(np.float32)
+        split_pieces = []
+        split_palettes = []
+        for piece, palette in zip(pieces, palettes):
+            piece_tris = tris if piece is None else tris[piece]
+            if len(np.unique(piece_tris)) <= 0x10000:
+                split_pieces.append(piece)
+                split_palettes.append(palette)
+                continue
+            piece_ids = np.arange(len(tris)) if piece is None else piece
+            for sub in split_triangles(piece_tris, tri_materials[piece_ids], positions):
+                split_pieces.append(piece_ids[np.sort(sub)])
+                split_palettes.append(palette)
+        if len(split_pieces) > len(pieces):
+            print("Split %d vertices into %d UINT16 submeshes" % (len(verts), len(split_pieces)))
+        pieces = split_pieces
+        palettes = split_palettes
+
+    parts = []
+    for piece, palette in zip(pieces, palettes):
+        if piece is None:
+            part_tris, part_verts, part_ranges = tris, verts, material_ranges
+        else:
+            piece_order, part_ranges = group_triangles_by_material(tri_materials[piece], arrays["material_count"])
+            part_tris, used = get_local_vertices(tris[piece[piece_order]])
+            part_verts = verts[used]
+            if palette is not None:
+                lookup = np.zeros(int(bone_ids.max()) + 1, dtype=np.int64)
+                lookup[palette] = np.arange(len(palette))
+                local_bones = np.where(part_verts["BLEND_WEIGHTS_0"] > 0, lookup[bone_ids[used]], 0)
+                part_verts["BLEND_INDICES_0"] = local_bones
+
+        if settings["vcache"] == 1 and len(part_tris):
+            acmr, atvr = get_cache_stats(part_tris)
+            part_tris, part_verts = optimize_vertex_cache(part_tris, part_verts, part_ranges)
+            new_acmr, new_atvr = get_cache_stats(part_tris)
+            print("Vertex cache (FIFO %d): ACMR %.3f -> %.3f, ATVR %.3f -> %.3f" % (
+                VERTEX_CACHE_SIZE, acmr, new_acmr, atvr, new_atvr))
+
+        ## The index width is picked per mesh, UINT32 only when UINT16 can't address it
+        if len(part_verts) > 0x10000:
+            polygon_type = "UINT32"
+            polys = part_tris.astype("<u4")
+        else:
+            polygon_type = "UINT16"
+            polys = part_tris.astype("<u2")
+
+        part = {
+            "index_buffer": memoryview(polys.reshape(-1).view(np.uint8)),
+            "vertex_buffer": memoryview(part_verts.view(np.uint8).reshape(-1)),
+            "material_ranges": part_ranges,
+            "polygon_type": polygon_type,
+        }
+        if palette is not None:
+            part["bone_palette"] = palette.tolist()
+        parts.append(part)
+
+    return parts
+
+
+def share_arrays(arrays):
+    ## Copies the numpy arrays of one object into a single shared memory block,
+    ## returns the block and what a worker needs to find them in it again
+    specs = []
+    size = 0
+    for key, value in arrays.items():
+        if isinstance(value, np.ndarray):
+            size += -size % 16
+            specs.append((key, value.dtype.str, value.shape, size))
+            size += value.nbytes
+
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for key, dtype, shape, offset in specs:
+        np.ndarray(shape, dtype, block.buf, offset)[...] = arrays[key]
+    scalars = {key: value for key, value in arrays.items() if not isinstance(value, np.ndarray)}
+    return block, (block.name, specs, scalars)
+
+
+def build_shared_mesh_parts(shared, settings):
+    ## Worker side of build_mesh_parts_in_pool
+    name, specs, scalars = shared
+    block = shared_memory.SharedMemory(name=name)
+    arrays = dict(scalars)
+    for key, dtype, shape, offset in specs:
+        arrays[key] = np.ndarray(shape, dtype, block.buf, offset)
+
+    parts = build_mesh_parts(arrays, compile_vertex_layout(settings), settings)
+    for part in parts:
+        part["index_buffer"] = bytes(part["index_buffer"])
+        part["vertex_buffer"] = bytes(part["vertex_buffer"])
+
+    ## Views into the block have to be gone before it can be closed
+    arrays.clear()
+    block.close()
+    return parts
+
+
+@contextmanager
+def spawn_safe_main():
+    ## Spawned workers import the parent's __main__ from its file. Under Blender
+    ## that is the text editor script, which needs bpy, so it's hidden while the
+    ## pool starts its workers. They only need this module, found on sys.path.
+    main = sys.modules.get("__main__")
+    hidden = {}
+    for attr in ("__file__", "__spec__"):
+        if getattr(main, attr, None) is not None:
+            hidden[attr] = getattr(main, attr)
+            setattr(main, attr, None)
+    try:
+        yield
+    finally:
+        for attr, value in hidden.items():
+            setattr(main, attr, value)
+
+
+def build_mesh_parts_in_pool(arrays_list, settings, workers):
+    ## build_mesh_parts for several objects at once in a process pool. The arrays
+    ## go through shared memory, the parts come back in the order of arrays_list
+    blocks = []
+    try:
+        shared = []
+        for arrays in arrays_list:
+            block, spec = share_arrays(arrays)
+            blocks.append(block)
+            shared.append(spec)
+
+        context = multiprocessing.get_context("spawn")
+        with spawn_safe_main(), ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            return list(pool.map(build_shared_mesh_parts, shared, [settings] * len(shared)))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,570 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+
+## Reading and writing of the Trinity files without flatc.
+## The schemas below follow the PokeDocs SV trmsh/trmbf schemas, fields are
+## listed in their vtable slot order and take the same names as the json.
+
+TRINITY_ENUMS = {
+    "VertexAttribute": {
+        "NONE": 0,
+        "POSITION": 1,
+        "NORMAL": 2,
+        "TANGENT": 3,
+        "BINORMAL": 4,
+        "COLOR": 5,
+        "TEXCOORD": 6,
+        "BLEND_INDICES": 7,
+        "BLEND_WEIGHTS": 8,
+    },
+    "Type": {
+        "NONE": 0,
+        "RGBA_8_UNORM": 20,
+        "RGBA_8_UNSIGNED": 22,
+        "R_32_UINT": 36,
+        "R_32_INT": 37,
+        "RGBA_16_UNORM": 39,
+        "RGBA_16_FLOAT": 43,
+        "RG_32_FLOAT": 48,
+        "RGB_32_FLOAT": 51,
+        "RGBA_32_FLOAT": 54,
+    },
+    "PolygonType": {
+        "UINT8": 0,
+        "UINT16": 1,
+        "UINT32": 2,
+        "UINT64": 3,
+    },
+}
+
+## Structs are stored inline, (struct format, json -> values)
+TRINITY_STRUCTS = {
+    "BoundingBox": (
+        struct.Struct("<6f"),
+        lambda v: (v["min"]["x"], v["min"]["y"], v["min"]["z"], v["max"]["x"], v["max"]["y"], v["max"]["z"]),
+    ),
+    "Sphere": (
+        struct.Struct("<4f"),
+        lambda v: (v["x"], v["y"], v["z"], v["radius"]),
+    ),
+}
+
+TRMBF_SCHEMA = {
+    "root": "TRMBF",
+    "tables": {
+        "TRMBF": [("unused", "uint32"), ("buffers", "[Buffer]")],
+        "Buffer": [("index_buffer", "[IndexBuffer]"), ("vertex_buffer", "[VertexBuffer]")],
+        "IndexBuffer": [("buffer", "[ubyte]")],
+        "VertexBuffer": [("buffer", "[ubyte]")],
+    },
+}
+
+TRMSH_SCHEMA = {
+    "root": "TRMSH",
+    "tables": {
+        "TRMSH": [("unk0", "uint32"), ("meshes", "[MeshShape]"), ("buffer_name", "string")],
+        "MeshShape": [
+            ("mesh_shape_name", "string"),
+            ("bounds", "BoundingBox"),
+            ("polygon_type", "PolygonType"),
+            ("attributes", "[VertexAccessors]"),
+            ("materials", "[MaterialInfo]"),
+            ("res0", "uint32"),
+            ("res1", "uint32"),
+            ("res2", "uint32"),
+            ("res3", "uint32"),
+            ("clip_sphere", "Sphere"),
+            ("influence", "[Influence]"),
+            ("vis_shapes", "[VisShape]"),
+            ("mesh_name", "string"),
+            ("unk13", "uint32"),
+        ],
+        "VertexAccessors": [("attrs", "[VertexAttributeInfo]"), ("size", "[VertexSize]")],
+        "VertexAttributeInfo": [
+            ("attr_0", "uint32"),
+            ("attribute", "VertexAttribute"),
+            ("attribute_layer", "uint32"),
+            ("type", "Type"),
+            ("position", "uint32"),
+        ],
+        "VertexSize": [("size", "uint32")],
+        "MaterialInfo": [
+            ("material_name", "string"),
+            ("poly_offset", "uint32"),
+            ("poly_count", "uint32"),
+            ("sh_unk3", "uint32"),
+            ("sh_unk4", "uint32"),
+        ],
+        "Influence": [("index", "uint32"), ("scale", "float")],
+        "VisShape": [("index", "uint32"), ("name", "string")],
+    },
+}
+
+SCALAR_FORMATS = {
+    "uint32": struct.Struct("<I"),
+    "float": struct.Struct("<f"),
+}
+
+## Byte arrays are written to json this many values at a time
+JSON_BLOCK_SIZE = 1 << 16
+BYTE_STRINGS = [str(i) for i in range(256)]
+
+## Json files are scanned and copied in chunks of this many bytes
+JSON_CHUNK_SIZE = 1 << 20
+JSON_INDENT = "    "
+JSON_ARRAY_KEY = re.compile(rb'"((?:[^"\\]|\\.)*)"\s*:\s*\[')
+JSON_NUMBER = re.compile(rb"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+## Integers json.dumps writes back unchanged, the usual case for buffers
+JSON_PLAIN_INTS = re.compile(rb"(?:(?:0|-?[1-9]\d*),)*(?:0|-?[1-9]\d*)")
+
+uoffsetFormat = struct.Struct("<I")
+soffsetFormat = struct.Struct("<i")
+vtableFormat = struct.Struct("<HH")
+vec3Format = struct.Struct("<3f")
+
+## TRSKL vtable slots, same order as the offsets readtrskl used to read one by one
+TRSKL_SLOT_BONES = 1
+TRSKL_SLOT_BONE_ADJUST = 4
+BONE_SLOT_NAME = 0
+BONE_SLOT_TRANSFORM = 1
+BONE_SLOT_PARENT = 4
+BONE_SLOT_RIG_ID = 5
+BONE_SLOT_MERGE = 6
+TRANSFORM_SLOT_SCALE = 0
+TRANSFORM_SLOT_ROTATION = 1
+TRANSFORM_SLOT_TRANSLATION = 2
+
+## Parsed skeletons by path, reused while the file's mtime and size don't change
+trskl_cache = {}
+
+
+class FlatBufferWriter:
+    ## Lays the buffer out front to back: every table is written before the
+    ## strings, vectors and tables it points to, so all uoffsets are positive.
+    ## Byte vectors are kept as memoryview parts and never copied.
+
+    def __init__(self, schema, dedup=False):
+        self.tables = schema["tables"]
+        self.root = schema["root"]
+        self.parts = []
+        self.head = None
+        self.size = 0
+        ## Byte vectors go after every table, so any slot can point at any of
+        ## them and identical ones can share one copy when dedup is on
+        self.byte_vectors = []
+        self.dedup = dedup
+        self.saved = 0
+
+    def write(self, data):
+        if self.head is None:
+            self.head = bytearray()
+            self.parts.append(self.head)
+        slot = (self.head, len(self.head), self.size)
+        self.head += data
+        self.size += len(data)
+        return slot
+
+    def write_view(self, view):
+        self.parts.append(view)
+        self.size += len(view)
+        self.head = None
+
+    def pad(self, align):
+        if self.size % align:
+            self.write(bytes(align - self.size % align))
+
+    def patch(self, slot, target):
+        chunk, local, pos = slot
+        uoffsetFormat.pack_into(chunk, local, target - pos)
+
+    def build(self, data):
+        root_slot = self.write(bytes(4))
+        self.patch(root_slot, self.write_table(self.root, data))
+        self.write_byte_vectors()
+        return self
+
+    def write_byte_vectors(self):
+        written = {}
+        for slot, view in self.byte_vectors:
+            key = None
+            if self.dedup:
+                key = (len(view), hashlib.blake2b(view, digest_size=16).digest())
+                if key in written and written[key][1] == view:
+                    self.patch(slot, written[key][0])
+                    self.saved += len(view)
+                    continue
+            self.pad(4)
+            pos = self.write(uoffsetFormat.pack(len(view)))[2]
+            self.write_view(view)
+            self.patch(slot, pos)
+            if key is not None:
+                written[key] = (pos, view)
+
+    def write_table(self, name, data):
+        fields = self.tables[name]
+        vtable = [0] * len(fields)
+        body = bytearray(4)
+        children = []
+
+        for index, (field, kind) in enumerate(fields):
+            if field not in data:
+                continue
+            value = data[field]
+            if kind in SCALAR_FORMATS or kind in TRINITY_ENUMS:
+                if kind in TRINITY_ENUMS and isinstance(value, str):
+                    value = TRINITY_ENUMS[kind][value]
+                if value == 0:
+                    continue
+                vtable[index] = len(body)
+                body += SCALAR_FORMATS.get(kind, SCALAR_FORMATS["uint32"]).pack(value)
+            elif kind in TRINITY_STRUCTS:
+                fmt, get_values = TRINITY_STRUCTS[kind]
+                vtable[index] = len(body)
+                body += fmt.pack(*get_values(value))
+            else:
+                vtable[index] = len(body)
+                children.append((len(body), kind, value))
+                body += bytes(4)
+
+        ## Trailing empty slots don't need to be stored
+        while vtable and vtable[-1] == 0:
+            vtable.pop()
+        vtable_bytes = struct.pack("<%dH" % (len(vtable) + 2), 4 + 2 * len(vtable), len(body), *vtable)
+
+        ## The table itself has to start 4 byte aligned right after its vtable
+        self.write(bytes((-(self.size + len(vtable_bytes))) % 4))
+        self.write(vtable_bytes)
+        chunk, local, table_pos = self.write(body)
+        soffsetFormat.pack_into(chunk, local, len(vtable_bytes))
+
+        for field_offset, kind, value in children:
+            self.write_child(kind, value, (chunk, local + field_offset, table_pos + field_offset))
+
+        return table_pos
+
+    def write_child(self, kind, value, slot):
+        if kind == "[ubyte]":
+            self.byte_vectors.append((slot, memoryview(value).cast("B")))
+            return
+        self.pad(4)
+        if kind == "string":
+            encoded = value.encode("utf-8")
+            pos = self.write(uoffsetFormat.pack(len(encoded)) + encoded + b"\0")[2]
+        elif kind.startswith("["):
+            pos = self.write(uoffsetFormat.pack(len(value)))[2]
+            item_slots = [self.write(bytes(4)) for item in value]
+            for item_slot, item in zip(item_slots, value):
+                self.patch(item_slot, self.write_table(kind[1:-1], item))
+        else:
+            pos = self.write_table(kind, value)
+        self.patch(slot, pos)
+
+    def save(self, filepath):
+        with open(filepath, "wb") as f:
+            for part in self.parts:
+                f.write(part)
+
+
+def write_trmbf(filepath, data, dedup=False):
+    ## With dedup identical index/vertex buffers are stored once, the meshes
+    ## keep their own Buffer entries, returns the number of bytes saved
+    writer = FlatBufferWriter(TRMBF_SCHEMA, dedup).build(data)
+    writer.save(filepath)
+    return writer.saved
+
+
+def write_trmsh(filepath, data):
+    FlatBufferWriter(TRMSH_SCHEMA).build(data).save(filepath)
+
+
+def read_table_fields(view, pos):
+    ## Field offsets of the table at pos, missing slots read as 0
+    vtable = pos - soffsetFormat.unpack_from(view, pos)[0]
+    vtable_size = vtableFormat.unpack_from(view, vtable)[0]
+    return struct.unpack_from("<%dH" % ((vtable_size - 4) // 2), view, vtable + 4)
+
+
+def get_field(fields, slot):
+    return fields[slot] if slot < len(fields) else 0
+
+
+def read_uoffset(view, pos):
+    return pos + uoffsetFormat.unpack_from(view, pos)[0]
+
+
+def read_string(view, pos):
+    pos = read_uoffset(view, pos)
+    length = uoffsetFormat.unpack_from(view, pos)[0]
+    return bytes(view[pos + 4:pos + 4 + length]).decode("utf-8")
+
+
+def read_trskl_bone(view, pos, bone_adjust):
+    fields = read_table_fields(view, pos)
+    bone = {
+        "name": "",
+        "rig_id": None,
+        "parent": 0,
+        "merge": "",
+        "scale": (1.0, 1.0, 1.0),
+        "rotation": (0.0, 0.0, 0.0),
+        "translation": (0.0, 0.0, 0.0),
+        "has_transform": False,
+    }
+
+    if get_field(fields, BONE_SLOT_NAME):
+        bone["name"] = read_string(view, pos + fields[BONE_SLOT_NAME])
+    if get_field(fields, BONE_SLOT_MERGE):
+        bone["merge"] = read_string(view, pos + fields[BONE_SLOT_MERGE])
+    if get_field(fields, BONE_SLOT_PARENT):
+        bone["parent"] = soffsetFormat.unpack_from(view, pos + fields[BONE_SLOT_PARENT])[0]
+    if get_field(fields, BONE_SLOT_RIG_ID):
+        bone["rig_id"] = soffsetFormat.unpack_from(view, pos + fields[BONE_SLOT_RIG_ID])[0] + bone_adjust
+
+    if get_field(fields, BONE_SLOT_TRANSFORM):
+        transform = read_uoffset(view, pos + fields[BONE_SLOT_TRANSFORM])
+        transform_fields = read_table_fields(view, transform)
+        if len(transform_fields) != 3:
+            raise AssertionError("Unexpected bone position struct length!")
+        for key, slot in (
+            ("scale", TRANSFORM_SLOT_SCALE),
+            ("rotation", TRANSFORM_SLOT_ROTATION),
+            ("translation", TRANSFORM_SLOT_TRANSLATION),
+        ):
+            if transform_fields[slot]:
+                bone[key] = vec3Format.unpack_from(view, transform + transform_fields[slot])
+        bone["has_transform"] = True
+    return bone
+
+
+def parse_trskl(view):
+    root = read_uoffset(view, 0)
+    fields = read_table_fields(view, root)
+
+    bone_adjust = 0
+    if get_field(fields, TRSKL_SLOT_BONE_ADJUST):
+        bone_adjust = soffsetFormat.unpack_from(view, root + fields[TRSKL_SLOT_BONE_ADJUST])[0]
+
+    bones = []
+    if get_field(fields, TRSKL_SLOT_BONES):
+        vector = read_uoffset(view, root + fields[TRSKL_SLOT_BONES])
+        count = uoffsetFormat.unpack_from(view, vector)[0]
+        for index in range(count):
+            item = vector + 4 + 4 * index
+            bones.append(read_trskl_bone(view, read_uoffset(view, item), bone_adjust))
+    return {"bone_adjust": bone_adjust, "bones": bones}
+
+
+def read_trskl(filepath):
+    ## Bone table of a TRSKL: name, rig ID (mesh node ID adjust applied, None
+    ## without one), parent, merge name and scale/rotation/translation per bone.
+    ## The file is memory mapped and decoded in place, and the result is cached
+    ## until the file changes, so treat it as read only.
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = trskl_cache.get(filepath)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    print("Parsing TRSKL...")
+    with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            skeleton = parse_trskl(view)
+        finally:
+            view.release()
+    if skeleton["bone_adjust"]:
+        print(f"Mesh node IDs start at {skeleton['bone_adjust']}")
+
+    trskl_cache[filepath] = (key, skeleton)
+    return skeleton
+
+
+def get_trskl_bone_dict(skeleton):
+    ## Bone name -> rig ID for the bones the exporter can skin to
+    bone_dict = {}
+    for bone in skeleton["bones"]:
+        if bone["has_transform"] and bone["rig_id"] is not None:
+            bone_dict[bone["name"]] = bone["rig_id"]
+    return bone_dict
+
+
+def write_json_value(f, value):
+    if isinstance(value, dict):
+        f.write("{")
+        for index, (key, item) in enumerate(value.items()):
+            if index:
+                f.write(",")
+            f.write(json.dumps(key))
+            f.write(":")
+            write_json_value(f, item)
+        f.write("}")
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        ## Buffers go out block by block, the full list of ints is never built
+        view = memoryview(value).cast("B")
+        f.write("[")
+        for start in range(0, len(view), JSON_BLOCK_SIZE):
+            if start:
+                f.write(",")
+            f.write(",".join(map(BYTE_STRINGS.__getitem__, view[start:start + JSON_BLOCK_SIZE])))
+        f.write("]")
+    elif isinstance(value, (list, tuple)):
+        f.write("[")
+        for index, item in enumerate(value):
+            if index:
+                f.write(",")
+            write_json_value(f, item)
+        f.write("]")
+    else:
+        f.write(json.dumps(value))
+
+
+def write_json(filepath, data):
+    ## Compact json for flatc, streamed to the file instead of built with json.dumps
+    with open(filepath, "w", encoding="utf-8", buffering=1 << 20) as f:
+        write_json_value(f, data)
+
+
+class JsonArraySpan:
+    ## A number array inside a json file, copied to the output number by number
+    ## without ever being loaded as a list
+
+    def __init__(self, filepath, start, end):
+        self.filepath = filepath
+        self.start = start
+        self.end = end
+
+    def write(self, f, level):
+        indent = "\n" + JSON_INDENT * (level + 1)
+        first = True
+        tail = b""
+        with open(self.filepath, "rb") as infile:
+            infile.seek(self.start)
+            remaining = self.end - self.start
+            while remaining > 0:
+                chunk = infile.read(min(JSON_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                data = tail + chunk
+                ## A number cut off by the chunk end waits for the next chunk
+                cut = len(data)
+                if remaining > 0:
+                    cut = max(data.rfind(sep) for sep in (b",", b" ", b"\n", b"\r", b"\t")) + 1
+                tail = data[cut:]
+
+                numbers = b",".join(JSON_NUMBER.findall(data, 0, cut))
+                if numbers:
+                    if JSON_PLAIN_INTS.fullmatch(numbers):
+                        numbers = numbers.decode("ascii").split(",")
+                    else:
+                        numbers = [json.dumps(json.loads(number)) for number in numbers.split(b",")]
+                    f.write(("[" if first else ",") + indent + ("," + indent).join(numbers))
+                    first = False
+        f.write("[]" if first else "\n" + JSON_INDENT * level + "]")
+
+    def read_bytes(self):
+        ## The array as bytes, for byte arrays that go into a binary file
+        data = bytearray()
+        tail = b""
+        with open(self.filepath, "rb") as infile:
+            infile.seek(self.start)
+            remaining = self.end - self.start
+            while remaining > 0:
+                chunk = infile.read(min(JSON_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                chunk = tail + chunk
+                cut = len(chunk)
+                if remaining > 0:
+                    cut = max(chunk.rfind(sep) for sep in (b",", b" ", b"\n", b"\r", b"\t")) + 1
+                tail = chunk[cut:]
+                data += bytes(map(int, JSON_NUMBER.findall(chunk, 0, cut)))
+        return data
+
+
+class JsonFile:
+    ## A small json file, only loaded while it is being written out
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def write(self, f, level):
+        with open(self.filepath, "rb") as infile:
+            value = json.loads(infile.read())
+        write_json_indented(f, value, level)
+
+
+def find_json_arrays(filepath):
+    ## Byte spans of the arrays in a json file whose arrays only hold numbers,
+    ## by key. The file is scanned in chunks, never loaded as a whole.
+    spans = {}
+    key = None
+    start = None
+    offset = 0
+    tail = b""
+    with open(filepath, "rb") as infile:
+        while True:
+            chunk = infile.read(JSON_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = tail + chunk
+            base = offset - len(tail)
+            offset += len(chunk)
+            pos = 0
+            tail = b""
+            while True:
+                if start is None:
+                    match = JSON_ARRAY_KEY.search(data, pos)
+                    if match is None:
+                        ## Keep enough to find a key split by the chunk end
+                        tail = data[max(pos, len(data) - 256):]
+                        break
+                    key = json.loads(b'"' + match.group(1) + b'"')
+                    start = base + match.end()
+                    pos = match.end()
+                else:
+                    end = data.find(b"]", pos)
+                    if end < 0:
+                        break
+                    spans[key] = JsonArraySpan(filepath, start, base + end)
+                    start = None
+                    pos = end + 1
+    return spans
+
+
+def write_json_indented(f, value, level=0):
+    ## Same output as json.dumps(value, indent=4), written piece by piece.
+    ## JsonArraySpan and JsonFile values are streamed from their files and
+    ## byte-likes are written like lists of their bytes.
+    if isinstance(value, (JsonArraySpan, JsonFile)):
+        value.write(f, level)
+    elif isinstance(value, (bytes, bytearray, memoryview)) and len(value):
+        indent = "\n" + JSON_INDENT * (level + 1)
+        view = memoryview(value).cast("B")
+        f.write("[")
+        for start in range(0, len(view), JSON_BLOCK_SIZE):
+            f.write(("," if start else "") + indent)
+            f.write(("," + indent).join(map(BYTE_STRINGS.__getitem__, view[start:start + JSON_BLOCK_SIZE])))
+        f.write("\n" + JSON_INDENT * level + "]")
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        f.write("[]")
+    elif isinstance(value, dict) and value:
+        f.write("{")
+        for index, (key, item) in enumerate(value.items()):
+            f.write(("," if index else "") + "\n" + JSON_INDENT * (level + 1) + json.dumps(str(key)) + ": ")
+            write_json_indented(f, item, level + 1)
+        f.write("\n" + JSON_INDENT * level + "}")
+    elif isinstance(value, list) and value:
+        f.write("[")
+        for index, item in enumerate(value):
+            f.write(("," if index else "") + "\n" + JSON_INDENT * (level + 1))
+            write_json_indented(f, item, level + 1)
+        f.write("\n" + JSON_INDENT * level + "]")
+    else:
+        f.write(json.dumps(value))
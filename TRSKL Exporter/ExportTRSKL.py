@@ -12,8 +12,10 @@ bl_info = {
 import bpy
 import json
 import os
+import numpy as np
 from bpy_extras.io_utils import ExportHelper
-from mathutils import Matrix, Vector
+from bpy.props import BoolProperty
+from mathutils import Matrix
 from math import *
 class TRSKLJsonExport(bpy.types.Operator, ExportHelper):
     bl_idname = "custom_export_scene.trskljsonexport"
@@ -22,12 +24,18 @@ class TRSKLJsonExport(bpy.types.Operator, ExportHelper):
 
     filename_ext = ".json"  # Specify the default file extension
 
+    nonzero_weights_only: BoolProperty(
+        name="Only Bones With Weights",
+        description="Skip bones whose vertex groups have no vertex with a weight above zero",
+        default=False,
+    )
+
     def execute(self, context):
         directory = os.path.dirname(self.filepath)
         armature_obj = bpy.context.active_object
 
         if armature_obj and armature_obj.type == 'ARMATURE':
-            data = export_armature_matrix(armature_obj)
+            data = export_armature_matrix(armature_obj, self.nonzero_weights_only)
             # Save the data to a JSON file
             with open(os.path.join(directory, self.filepath), "w") as file:
                 json.dump(data, file, indent=4)
@@ -46,30 +54,124 @@ rx90n = Matrix.Rotation(radians(-90),4,'X')
 ry90n = Matrix.Rotation(radians(-90),4,'Y')
 rz90n = Matrix.Rotation(radians(-90),4,'Z')
 
+# Single precision epsilon, Blender's euler conversion works in floats
+FLT_EPSILON = 1.1920929e-07
+
 
-def is_bone_weighted(armature, bone_name):
-    a = False
+def get_weighted_bone_names(armature, nonzero_only=False):
+    # Vertex group names of every mesh deformed by the armature, read straight
+    # from the data so no object has to be made active or switch modes
+    names = set()
     for obj in bpy.data.objects:
-        if obj.type == 'MESH':
-            for modifier in obj.modifiers:
-                if modifier.type == 'ARMATURE' and modifier.object == armature:
-                    bpy.context.view_layer.objects.active = obj
-                    bpy.ops.object.mode_set(mode='OBJECT')
+        if obj.type != 'MESH':
+            continue
+        if not any(modifier.type == 'ARMATURE' and modifier.object == armature for modifier in obj.modifiers):
+            continue
 
-                    armature_data = modifier.object.data
+        if nonzero_only:
+            # Only groups that actually move a vertex
+            used = set()
+            for vert in obj.data.vertices:
+                for gp in vert.groups:
+                    if gp.weight > 0:
+                        used.add(gp.group)
+            names.update(obj.vertex_groups[index].name for index in used)
+        else:
+            names.update(group.name for group in obj.vertex_groups)
 
-                    try:
+    return names
 
-                        bpy.ops.object.mode_set(mode='OBJECT')  # Switch back to OBJECT mode
+# The matrix maths below stays in float32 and follows the steps mathutils
+# takes, so the rounded values match what Matrix operations gave per bone
+
+def get_pose_matrices(pose_bones):
+    # foreach_get gives each matrix column by column, like Blender stores them
+    matrices = np.empty(len(pose_bones) * 16, dtype=np.float32)
+    pose_bones.foreach_get("matrix", matrices)
+    return matrices.reshape(-1, 4, 4).transpose(0, 2, 1)
+
+
+def multiply_matrices(a, b):
+    # a @ b with every sum added left to right in float32, like mul_m4_m4m4
+    result = a[..., :, 0:1] * b[..., 0:1, :]
+    for k in range(1, 4):
+        result = result + a[..., :, k:k + 1] * b[..., k:k + 1, :]
+    return result
+
+
+def determinant_3x3(a1, a2, a3, b1, b2, b3, c1, c2, c3):
+    return a1 * (b2 * c3 - b3 * c2) - a2 * (b1 * c3 - b3 * c1) + a3 * (b1 * c2 - b2 * c1)
+
+
+def invert_matrices(matrices):
+    # Matrix.inverted() for a stack of matrices: the adjoint divided by the
+    # determinant, the same cofactors as Blender's adjoint_m4_m4/determinant_m4
+    m = matrices.transpose(0, 2, 1)  # Blender's column major m[col][row]
+    a1, b1, c1, d1 = (m[:, 0, i] for i in range(4))
+    a2, b2, c2, d2 = (m[:, 1, i] for i in range(4))
+    a3, b3, c3, d3 = (m[:, 2, i] for i in range(4))
+    a4, b4, c4, d4 = (m[:, 3, i] for i in range(4))
+
+    adjoint = np.empty_like(m)
+    adjoint[:, 0, 0] = determinant_3x3(b2, b3, b4, c2, c3, c4, d2, d3, d4)
+    adjoint[:, 1, 0] = -determinant_3x3(a2, a3, a4, c2, c3, c4, d2, d3, d4)
+    adjoint[:, 2, 0] = determinant_3x3(a2, a3, a4, b2, b3, b4, d2, d3, d4)
+    adjoint[:, 3, 0] = -determinant_3x3(a2, a3, a4, b2, b3, b4, c2, c3, c4)
+    adjoint[:, 0, 1] = -determinant_3x3(b1, b3, b4, c1, c3, c4, d1, d3, d4)
+    adjoint[:, 1, 1] = determinant_3x3(a1, a3, a4, c1, c3, c4, d1, d3, d4)
+    adjoint[:, 2, 1] = -determinant_3x3(a1, a3, a4, b1, b3, b4, d1, d3, d4)
+    adjoint[:, 3, 1] = determinant_3x3(a1, a3, a4, b1, b3, b4, c1, c3, c4)
+    adjoint[:, 0, 2] = determinant_3x3(b1, b2, b4, c1, c2, c4, d1, d2, d4)
+    adjoint[:, 1, 2] = -determinant_3x3(a1, a2, a4, c1, c2, c4, d1, d2, d4)
+    adjoint[:, 2, 2] = determinant_3x3(a1, a2, a4, b1, b2, b4, d1, d2, d4)
+    adjoint[:, 3, 2] = -determinant_3x3(a1, a2, a4, b1, b2, b4, c1, c2, c4)
+    adjoint[:, 0, 3] = -determinant_3x3(b1, b2, b3, c1, c2, c3, d1, d2, d3)
+    adjoint[:, 1, 3] = determinant_3x3(a1, a2, a3, c1, c2, c3, d1, d2, d3)
+    adjoint[:, 2, 3] = -determinant_3x3(a1, a2, a3, b1, b2, b3, d1, d2, d3)
+    adjoint[:, 3, 3] = determinant_3x3(a1, a2, a3, b1, b2, b3, c1, c2, c3)
+
+    determinant = (a1 * determinant_3x3(b2, b3, b4, c2, c3, c4, d2, d3, d4)
+                   - b1 * determinant_3x3(a2, a3, a4, c2, c3, c4, d2, d3, d4)
+                   + c1 * determinant_3x3(a2, a3, a4, b2, b3, b4, d2, d3, d4)
+                   - d1 * determinant_3x3(a2, a3, a4, b2, b3, b4, c2, c3, c4))
+    if np.any(determinant == 0):
+        raise ValueError("Matrix does not have an inverse")
+
+    # The inverse is the adjoint over the determinant, transposed back to rows
+    return (adjoint / determinant[:, None, None]).transpose(0, 2, 1)
+
+
+def matrix_to_euler(matrices):
+    # Matrix.to_euler() (XYZ) for a stack of matrices, same steps as Blender's
+    # mat3_normalized_to_eul: normalize the axes, build both solutions and keep
+    # the one with the smaller angles
+    mat = matrices[:, :3, :3]
+    length = np.sqrt(mat[:, 0:1, :] * mat[:, 0:1, :] + mat[:, 1:2, :] * mat[:, 1:2, :] + mat[:, 2:3, :] * mat[:, 2:3, :])
+    # normalize_v3 multiplies by the reciprocal of the length
+    scale = np.divide(np.float32(1.0), length, out=np.zeros_like(length), where=length > 1.0e-35)
+    mat = mat * scale
+    cy = np.hypot(mat[:, 0, 0], mat[:, 1, 0])
+
+    eul1 = np.stack([
+        np.arctan2(mat[:, 2, 1], mat[:, 2, 2]),
+        np.arctan2(-mat[:, 2, 0], cy),
+        np.arctan2(mat[:, 1, 0], mat[:, 0, 0]),
+    ], axis=1)
+    eul2 = np.stack([
+        np.arctan2(-mat[:, 2, 1], -mat[:, 2, 2]),
+        np.arctan2(-mat[:, 2, 0], -cy),
+        np.arctan2(-mat[:, 1, 0], -mat[:, 0, 0]),
+    ], axis=1)
+    gimbal = np.stack([
+        np.arctan2(-mat[:, 1, 2], mat[:, 1, 1]),
+        np.arctan2(-mat[:, 2, 0], cy),
+        np.zeros(len(mat), dtype=mat.dtype),
+    ], axis=1)
+
+    eul = np.where((np.abs(eul1).sum(axis=1) > np.abs(eul2).sum(axis=1))[:, None], eul2, eul1)
+    return np.where((cy > 16.0 * FLT_EPSILON)[:, None], eul, gimbal)
 
-                        # Check if the bone is in the vertex groups
-                        if bone_name in obj.vertex_groups:
-                            a = True
-                    except (KeyError, IndexError):
-                        pass
 
-    return a
-    
 def getEvaluatedPoseBones(armature_obj):
 	depsgraph = bpy.context.evaluated_depsgraph_get()
 	evaluated_armature = armature_obj.evaluated_get(depsgraph)
@@ -77,15 +179,7 @@ def getEvaluatedPoseBones(armature_obj):
 	return [evaluated_armature.pose.bones[bone.name] for bone in self.exportable_bones]
 
 
-def getSmdFloat(fval):
-	return "{:.6f}".format(float(fval))
-
-
-def getSmdVec(iterable):
-	return " ".join([getSmdFloat(val) for val in iterable])
-    
-    
-def export_armature_matrix(armature_obj):
+def export_armature_matrix(armature_obj, nonzero_only=False):
     transform_nodes = []
     bones = []
     data = {
@@ -104,12 +198,43 @@ def export_armature_matrix(armature_obj):
     bpy.context.view_layer.objects.active = armature_obj
     bpy.ops.object.mode_set(mode='POSE')
     mat_BlenderToSMD = ry90 @ rz90
-    for posebone in armature_obj.pose.bones:
+    weighted_bones = get_weighted_bone_names(armature_obj, nonzero_only)
+    pose_bones = armature_obj.pose.bones
+    bone_indices = {bone.name: index for index, bone in enumerate(armature_obj.data.bones)}
+
+    # Every bone's pose matrix in one (N,4,4) array, the products, inverses
+    # and euler angles below are done for all bones at once
+    pose_matrices = get_pose_matrices(pose_bones)
+    world_matrix = np.array(armature_obj.matrix_world, dtype=np.float32)[None]
+    # matrix_world.inverted() @ matrix_world is only close to identity in
+    # float32, it is kept so the bind matrices round like they always did
+    bind_matrices = multiply_matrices(
+        invert_matrices(pose_matrices),
+        multiply_matrices(invert_matrices(world_matrix), world_matrix),
+    )
+
+    node_matrices = pose_matrices
+    if armature_obj.data.vs.legacy_rotation:
+        node_matrices = multiply_matrices(node_matrices, np.array(mat_BlenderToSMD, dtype=np.float32)[None])
+    pose_indices = {posebone.name: index for index, posebone in enumerate(pose_bones)}
+    parents = np.array(
+        [pose_indices[posebone.parent.name] if posebone.parent else -1 for posebone in pose_bones],
+        dtype=np.int64,
+    )
+    has_parent = (parents >= 0)[:, None, None]
+    local_matrices = np.where(
+        has_parent,
+        multiply_matrices(invert_matrices(node_matrices)[np.maximum(parents, 0)], node_matrices),
+        multiply_matrices(world_matrix, node_matrices),
+    )
+    rotations = matrix_to_euler(local_matrices).tolist()
+    translations = local_matrices[:, :3, 3].tolist()
+    bind_matrices = bind_matrices.tolist()
+
+    for index, posebone in enumerate(pose_bones):
         inherit_position = 1  # Set tow 1 for example, you can modify this based on your requirements
-        result = is_bone_weighted(armature_obj, posebone.name)
-        parent = posebone.parent
-        matrix = posebone.matrix.inverted() @ (armature_obj.matrix_world.inverted()
-                                                          @ armature_obj.matrix_world)
+        result = posebone.name in weighted_bones
+        matrix = bind_matrices[index]
 
         if result == True:
             bones.append({
@@ -140,23 +265,15 @@ def export_armature_matrix(armature_obj):
                     }})
 
         if result == True:
-            bone_index = armature_obj.data.bones.find(posebone.name)
+            bone_index = bone_indices.get(posebone.name, -1)
         else:
             bone_index = -1
         # Get the parent index
         parent_index = -1  # Default value for bones without a parent
         if posebone.parent:
-            parent_index = armature_obj.data.bones.find(posebone.parent.name)
-        # Get the bone's Matrix from the current pose
-        PoseMatrix = posebone.matrix
-        if armature_obj.data.vs.legacy_rotation:
-            PoseMatrix @= mat_BlenderToSMD 
-        if parent:
-            parentMat = parent.matrix
-            if armature_obj.data.vs.legacy_rotation: parentMat @= mat_BlenderToSMD 
-            PoseMatrix = parentMat.inverted() @ PoseMatrix
-        else:
-            PoseMatrix = armature_obj.matrix_world @ PoseMatrix
+            parent_index = bone_indices.get(posebone.parent.name, -1)
+        rotation = rotations[index]
+        translation = translations[index]
 
         transform_nodes.append({
                 "name": posebone.name,
@@ -167,14 +284,14 @@ def export_armature_matrix(armature_obj):
                         "z": 1.0
                     },
                     "VecRot": {
-                        "x": float(getSmdVec(PoseMatrix.to_euler()).split()[0]),
-                        "y": float(getSmdVec(PoseMatrix.to_euler()).split()[1]),
-                        "z": float(getSmdVec(PoseMatrix.to_euler()).split()[2])
+                        "x": round(rotation[0], 6),
+                        "y": round(rotation[1], 6),
+                        "z": round(rotation[2], 6)
                     },
                     "VecTranslate": {
-                        "x": float(getSmdVec(PoseMatrix.to_translation()).split()[0]),
-                        "y": float(getSmdVec(PoseMatrix.to_translation()).split()[1]),
-                        "z": float(getSmdVec(PoseMatrix.to_translation()).split()[2])
+                        "x": round(translation[0], 6),
+                        "y": round(translation[1], 6),
+                        "z": round(translation[2], 6)
                     }
                 },
                 "scalePivot": {